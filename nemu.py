@@ -3,15 +3,30 @@ import re
 import time
 import asyncio
 import random
+import signal
+import bisect
+import hashlib
+import functools
 import logging
-import aiomysql
+import logging.handlers
+import queue
+import atexit
+import json
+import struct
+import zlib
+import argparse
+import sqlite3
 import threading
+import aiomysql
 import urllib.parse as urlparse
-from datetime import datetime
-from typing import Optional, Dict, Any
+from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Tuple, Set, Callable, Awaitable, List
 from aiogram import Bot, Dispatcher, F
+from aiohttp import web
 from aiogram.filters import Command, CommandStart
-from http.server import BaseHTTPRequestHandler, HTTPServer
 from aiogram.types import (
     Message, 
     CallbackQuery, 
@@ -21,11 +36,30 @@ from aiogram.types import (
     BotCommandScopeDefault
 )
 from aiogram.enums import ParseMode, ChatType, ChatAction
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Optional Redis-compatible backend for shared reply tracking
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
 # Bot token and database configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")
+REDIS_URL = os.getenv("REDIS_URL", "")
+MEDIA_WARMUP_CHAT_ID = os.getenv("MEDIA_WARMUP_CHAT_ID", "")
+
+# Run mode and HTTP server configuration
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()
+PORT = int(os.getenv("PORT", 10000))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
 # Array of image URLs
 IMAGES = [
@@ -167,23 +201,166 @@ KEYBOARD_BUTTONS = {
     "help_minimize": {"text": "📕 Minimize Help", "callback": "help_minimize"}
 }
 
+# Outbound Telegram rate limits (messages per second and burst size)
+RATE_LIMIT_CONFIG = {
+    "global_rate": 30.0,
+    "global_burst": 30,
+    "private_rate": 1.0,
+    "private_burst": 3,
+    "group_rate": 20 / 60,
+    "group_burst": 5,
+    "typing_reserve": 1,
+    "max_send_attempts": 3,
+    "max_tracked_chats": 10000
+}
+
+# Per-chat work scheduling configuration
+CHAT_WORK_CONFIG = {
+    "max_inflight_per_chat": 2,
+    "max_queued_per_chat": 8,
+    "max_queue_wait": 5.0,
+    "coalesce_window": 3.0,
+    "max_recent_queries": 20000
+}
+
+# Bot identity cache configuration
+BOT_IDENTITY_CONFIG = {
+    "refresh_interval": 6 * 3600
+}
+
+# Photo file_id cache configuration
+MEDIA_CACHE_CONFIG = {
+    "warmup_pause": 1.0
+}
+
+# Knowledge storage backend: "mysql" or the embedded "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mysql").lower()
+
+# Embedded SQLite storage settings
+SQLITE_CONFIG = {
+    "path": os.getenv("SQLITE_PATH", "nemu.db"),
+    "readers": int(os.getenv("SQLITE_READERS", 4))
+}
+
+# Knowledge snapshot settings
+SNAPSHOT_CONFIG = {
+    "path": os.getenv("KNOWLEDGE_SNAPSHOT_PATH", ""),
+    "chunk_rows": int(os.getenv("SNAPSHOT_CHUNK_ROWS", 5000)),
+    "compression_level": 6
+}
+
 # Database connection settings
 DATABASE_CONFIG = {
-    "minsize": 1,
-    "maxsize": 10,
-    "connect_timeout": 30,
+    "minsize": int(os.getenv("DB_POOL_MINSIZE", 2)),
+    "maxsize": int(os.getenv("DB_POOL_MAXSIZE", 10)),
+    "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", 30)),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 3600)),
     "echo": False
 }
 
-# Learning system configuration
+# Database deadlines in seconds
+DATABASE_TIMEOUTS = {
+    "acquire": float(os.getenv("DB_ACQUIRE_TIMEOUT", 3)),
+    "query": float(os.getenv("DB_QUERY_TIMEOUT", 5))
+}
+
+# Read replica routing settings (seconds)
+REPLICA_CONFIG = {
+    "check_interval": float(os.getenv("REPLICA_CHECK_INTERVAL", 2)),
+    "max_lag": float(os.getenv("REPLICA_MAX_LAG", 5)),
+    "read_your_writes_ttl": float(os.getenv("REPLICA_READ_YOUR_WRITES_TTL", 60)),
+    "max_recent_writes": 5000
+}
+
+# Database circuit breaker and degraded-mode journal settings
+CIRCUIT_BREAKER_CONFIG = {
+    "failure_threshold": int(os.getenv("DB_BREAKER_FAILURES", 5)),
+    "reset_timeout": float(os.getenv("DB_BREAKER_RESET_TIMEOUT", 15))
+}
+
+JOURNAL_CONFIG = {
+    "path": os.getenv("NEMU_JOURNAL_PATH", "nemu_journal.jsonl"),
+    "recovery_interval": float(os.getenv("DB_RECOVERY_INTERVAL", 10))
+}
+
+# Learning system configuration (tracking limits are per chat)
 LEARNING_CONFIG = {
     "max_learning_requests": 100,
     "max_bot_messages": 200,
+    "max_tracked_chats": 5000,
+    "learning_request_ttl": 86400,
+    "bot_message_ttl": 86400,
     "personality_chance": 0.15,
     "max_retries": 3,
     "retry_delay": 5
 }
 
+# In-memory knowledge index configuration
+KNOWLEDGE_INDEX_CONFIG = {
+    "enabled": True,
+    "load_batch_size": 5000,
+    "ngram_size": 3,
+    "max_partial_checks": 2000,
+    "refresh_interval": int(os.getenv("KNOWLEDGE_REFRESH_INTERVAL", "30")),
+    "refresh_overlap": 5
+}
+
+# Write-behind buffer configuration
+WRITE_BEHIND_CONFIG = {
+    "flush_interval": 5,
+    "max_pending_users": 500,
+    "max_buffered_triggers": 50000,
+    "max_buffered_users": 50000
+}
+
+# Response cache configuration
+RESPONSE_CACHE_CONFIG = {
+    "max_entries": 5000,
+    "ttl": 300,
+    "negative_ttl": 30
+}
+
+# Delayed reply configuration
+REPLY_CONFIG = {
+    "typing_delay": 2.0,
+    "adaptive_delay": False,
+    "chars_per_second": 40,
+    "min_delay": 0.5,
+    "max_delay": 3.0,
+    "max_pending": 200
+}
+
+# Shared reply-tracking state configuration
+STATE_CONFIG = {
+    "namespace": os.getenv("STATE_NAMESPACE", "nemu"),
+    "connect_timeout": 5
+}
+
+# Default latency histogram buckets in seconds
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Logging configuration
+LOG_CONFIG = {
+    "level": os.getenv("LOG_LEVEL", "INFO").upper(),
+    "format": os.getenv("LOG_FORMAT", "color").lower(),
+    "use_queue": os.getenv("LOG_QUEUE", "1") == "1",
+    "rate_per_message": 20.0,
+    "burst_per_message": 50
+}
+
+# Health and readiness configuration
+HEALTH_CONFIG = {
+    "loop_lag_interval": 0.5,
+    "max_loop_lag": 1.0,
+    "min_free_connections": 1
+}
+
+# Trigger hash backfill configuration
+BACKFILL_CONFIG = {
+    "batch_size": 500,
+    "pause": 0.05
+}
+
 # Color constants for logging
 class Colors:
     BLUE = LOG_COLORS['WARNING']
@@ -208,10 +385,87 @@ class ColoredFormatter(logging.Formatter):
         colored_format = f"{color}{original_format}{Colors.RESET}"
         return colored_format
 
+# JSON log formatter carrying user and chat context fields
+class JsonFormatter(logging.Formatter):
+    CONTEXT_FIELDS = ("user_id", "username", "full_name", "chat_id", "chat_type", "chat_title")
+
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in self.CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+# Rate-limit repeated DEBUG/INFO lines per message template; WARNING and above always pass
+class LogRateLimitFilter(logging.Filter):
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.dropped = 0
+        self._buckets: Dict[str, List[float]] = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        bucket = self._buckets.get(record.msg)
+        if bucket is None:
+            # Dynamic messages could grow the table, so reset it past a bound
+            if len(self._buckets) >= 1000:
+                self._buckets.clear()
+            bucket = [float(self.burst), now]
+            self._buckets[record.msg] = bucket
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+
+        self.dropped += 1
+        return False
+
+# Queue handler that leaves formatting to the listener thread
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Records stay in-process, so message args can be formatted later
+        return record
+
+# Lazily rendered user/chat context for log lines
+class UserLogDetail:
+    __slots__ = ("info",)
+
+    def __init__(self, info: Dict[str, Any]):
+        self.info = info
+
+    def __str__(self) -> str:
+        info = self.info
+        chat_link = f"https://t.me/{info['chat_username']}" if info["chat_username"] else "No Link"
+        return (
+            f"👤 {info['full_name']} (@{info['username']}) [ID: {info['user_id']}] | "
+            f"💬 {info['chat_title']} [{info['chat_id']}] ({info['chat_type']}) {chat_link}"
+        )
+
+# Listener draining the logging queue, if enabled
+log_listener = None
+log_rate_limiter = LogRateLimitFilter(LOG_CONFIG["rate_per_message"], LOG_CONFIG["burst_per_message"])
+
 # Setup colored logging system
 def setup_colored_logging():
+    global log_listener
+
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(LOG_CONFIG["level"])
 
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
@@ -219,12 +473,27 @@ def setup_colored_logging():
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.DEBUG)
 
-    formatter = ColoredFormatter(
-        fmt='%(asctime)s - %(name)s - [%(levelname)s] - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    if LOG_CONFIG["format"] == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = ColoredFormatter(
+            fmt='%(asctime)s - %(name)s - [%(levelname)s] - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+
+    if LOG_CONFIG["use_queue"]:
+        # Console writes happen on a listener thread, never on the event loop
+        log_queue = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(log_queue)
+        queue_handler.addFilter(log_rate_limiter)
+        logger.addHandler(queue_handler)
+        log_listener = logging.handlers.QueueListener(log_queue, console_handler, respect_handler_level=True)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+    else:
+        console_handler.addFilter(log_rate_limiter)
+        logger.addHandler(console_handler)
     return logger
 
 # Initialize logger instance
@@ -239,39 +508,1165 @@ except Exception as e:
     logger.error(f"❌ Failed to initialize bot: {e}")
     raise
 
+# In-memory index of normalized trigger -> best known response
+class KnowledgeIndex:
+    def __init__(self, ngram_size: int = 3, max_partial_checks: int = 2000):
+        self.loaded = False
+        self.ngram_size = ngram_size
+        self.max_partial_checks = max_partial_checks
+        self._entries: Dict[str, Tuple[int, str, int]] = {}
+        self._postings: Dict[str, List[str]] = {}
+        self._unsorted_postings: Set[str] = set()
+        self._first_gram_lengths: Dict[str, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, trigger_key: str) -> Optional[Tuple[int, str]]:
+        entry = self._entries.get(trigger_key)
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    def add(self, trigger_key: str, knowledge_id: int, response: str, usage: int = 0) -> None:
+        # Rows are loaded best-first, so keep the first entry seen for a key
+        if trigger_key not in self._entries:
+            self._entries[trigger_key] = (knowledge_id, response, usage)
+            self._index_ngrams(trigger_key)
+
+    def put(self, trigger_key: str, knowledge_id: int, response: str) -> None:
+        current = self._entries.get(trigger_key)
+        if current is None:
+            self._index_ngrams(trigger_key)
+        usage = current[2] if current and current[0] == knowledge_id else 0
+        self._entries[trigger_key] = (knowledge_id, response, usage)
+
+    def find_partial(self, query_key: str) -> Optional[Tuple[int, str]]:
+        n = self.ngram_size
+        query_length = len(query_key)
+        checks = self.max_partial_checks
+        candidates = set()
+
+        # Triggers containing the query: walk the rarest query n-gram's posting
+        # shortest-first, so the first hit is the closest and the walk is bounded
+        query_grams = self._ngrams(query_key)
+        if query_grams:
+            rarest = min(query_grams, key=lambda gram: (len(self._postings.get(gram, ())), gram))
+            hit_length = None
+            for trigger_key in self._sorted_posting(rarest):
+                if checks <= 0 or (hit_length is not None and len(trigger_key) > hit_length):
+                    break
+                checks -= 1
+                if query_key in trigger_key:
+                    candidates.add(trigger_key)
+                    hit_length = len(trigger_key)
+
+        # Triggers contained in the query: at each offset try the indexed trigger
+        # lengths for that leading n-gram, longest first
+        best_length = 0
+        for start in range(query_length - n + 1):
+            lengths = self._first_gram_lengths.get(query_key[start:start + n])
+            if not lengths:
+                continue
+            for length in reversed(lengths):
+                if length < best_length or checks <= 0:
+                    break
+                if start + length > query_length:
+                    continue
+                checks -= 1
+                fragment = query_key[start:start + length]
+                if fragment in self._entries:
+                    candidates.add(fragment)
+                    best_length = length
+                    break
+
+        # Triggers shorter than one n-gram are looked up as substrings
+        for start in range(query_length):
+            for length in range(1, n):
+                fragment = query_key[start:start + length]
+                if len(fragment) == length and fragment in self._entries:
+                    candidates.add(fragment)
+
+        if not candidates:
+            return None
+
+        best_key = max(
+            candidates,
+            key=lambda trigger_key: (
+                min(len(trigger_key), query_length) / max(len(trigger_key), query_length),
+                self._entries[trigger_key][2],
+                # Deterministic final tie-break, independent of the string hash seed
+                [-ord(char) for char in trigger_key]
+            )
+        )
+        entry = self._entries[best_key]
+        return entry[0], entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._postings.clear()
+        self._unsorted_postings.clear()
+        self._first_gram_lengths.clear()
+        self.loaded = False
+
+    def _ngrams(self, text: str) -> Set[str]:
+        n = self.ngram_size
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def _index_ngrams(self, trigger_key: str) -> None:
+        if len(trigger_key) < self.ngram_size:
+            return
+        for gram in self._ngrams(trigger_key):
+            self._postings.setdefault(gram, []).append(trigger_key)
+            self._unsorted_postings.add(gram)
+        lengths = self._first_gram_lengths.setdefault(trigger_key[:self.ngram_size], [])
+        position = bisect.bisect_left(lengths, len(trigger_key))
+        if position == len(lengths) or lengths[position] != len(trigger_key):
+            lengths.insert(position, len(trigger_key))
+
+    def _sorted_posting(self, gram: str) -> List[str]:
+        # Postings are sorted lazily by (length, text); re-sorting after a few appends is cheap
+        posting = self._postings.get(gram, [])
+        if gram in self._unsorted_postings:
+            posting.sort(key=lambda trigger_key: (len(trigger_key), trigger_key))
+            self._unsorted_postings.discard(gram)
+        return posting
+
+# Lookup tier names by cascade rank
+LOOKUP_TIERS = {
+    1: "exact",
+    2: "fulltext",
+    3: "partial"
+}
+
+# Pack (chat_id, message_id) into one integer key
+def pack_message_key(chat_id: int, message_id: int) -> int:
+    return (chat_id << 32) | message_id
+
+# Recover chat_id from a packed message key
+def chat_of_message_key(key: int) -> int:
+    return key >> 32
+
+# Sentinel returned by the response cache on a miss
+CACHE_MISS = object()
+
+# Bounded LRU cache with TTL for lookup results, including misses
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.negative_hits + self.misses
+        return (self.hits + self.negative_hits) / lookups if lookups else 0.0
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return CACHE_MISS
+
+        self._entries.move_to_end(key)
+        if entry[1] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value: Any) -> None:
+        self._store(key, value, self.ttl)
+
+    def put_negative(self, key: str) -> None:
+        self._store(key, None, self.negative_ttl)
+
+    def invalidate(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def drop_negative(self) -> None:
+        for key in [key for key, entry in self._entries.items() if entry[1] is None]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hit_rate, 4)
+        }
+
+    def _store(self, key: str, value: Any, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+# Insertion-ordered store with bounded capacity and TTL expiry
+class BoundedStore:
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, CACHE_MISS) is not CACHE_MISS
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._expire()
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return default
+        return entry[1]
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def _expire(self) -> None:
+        # Entries are kept in insertion order, so expired ones sit at the front
+        now = time.monotonic()
+        while self._entries:
+            expires_at = next(iter(self._entries.values()))[0]
+            if expires_at >= now:
+                break
+            self._entries.popitem(last=False)
+
+# Per-chat bounded stores keyed by packed (chat_id, message_id)
+class ChatScopedStore:
+    def __init__(self, per_chat_capacity: int, ttl: float, max_chats: int):
+        self.per_chat_capacity = per_chat_capacity
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, BoundedStore]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(store) for store in self._chats.values())
+
+    def __contains__(self, key: int) -> bool:
+        return self.get(key, CACHE_MISS) is not CACHE_MISS
+
+    def __setitem__(self, key: int, value: Any) -> None:
+        chat_id = chat_of_message_key(key)
+        store = self._chats.get(chat_id)
+        if store is None:
+            store = BoundedStore(self.per_chat_capacity, self.ttl)
+            self._chats[chat_id] = store
+        self._chats.move_to_end(chat_id)
+        store[key] = value
+
+        # Forget the least recently active chat once too many are tracked
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def get(self, key: int, default: Any = None) -> Any:
+        store = self._chats.get(chat_of_message_key(key))
+        if store is None:
+            return default
+        return store.get(key, default)
+
+    def pop(self, key: int, default: Any = None) -> Any:
+        chat_id = chat_of_message_key(key)
+        store = self._chats.get(chat_id)
+        if store is None:
+            return default
+        value = store.pop(key, default)
+        if not len(store):
+            del self._chats[chat_id]
+        return value
+
+# Process-local reply-tracking state
+class MemoryReplyState:
+    def __init__(self, store: ChatScopedStore):
+        self._store = store
+
+    async def get(self, key: int) -> Optional[str]:
+        return self._store.get(key)
+
+    async def set(self, key: int, value: Any) -> None:
+        self._store[key] = value
+
+    async def pop(self, key: int) -> Optional[str]:
+        return self._store.pop(key)
+
+    async def contains(self, key: int) -> bool:
+        return key in self._store
+
+    async def close(self) -> None:
+        pass
+
+# Reply-tracking state shared through a Redis-compatible store
+class RedisReplyState:
+    # Store the entry and trim the chat's index to capacity in one step
+    SET_SCRIPT = """
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+        local overflow = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+        if overflow > 0 then
+            local evicted = redis.call('ZRANGE', KEYS[2], 0, overflow - 1)
+            redis.call('DEL', unpack(evicted))
+            redis.call('ZREMRANGEBYRANK', KEYS[2], 0, overflow - 1)
+        end
+        redis.call('EXPIRE', KEYS[2], ARGV[2])
+    """
+
+    def __init__(self, client, kind: str, per_chat_capacity: int, ttl: int, owns_client: bool = False):
+        self._client = client
+        self._prefix = f"{STATE_CONFIG['namespace']}:{kind}"
+        self.per_chat_capacity = per_chat_capacity
+        self.ttl = int(ttl)
+        self._owns_client = owns_client
+        self._set_script = client.register_script(self.SET_SCRIPT)
+
+    async def get(self, key: int) -> Optional[str]:
+        return await self._client.get(self._entry_key(key))
+
+    async def set(self, key: int, value: Any) -> None:
+        await self._set_script(
+            keys=[self._entry_key(key), f"{self._prefix}:chat:{chat_of_message_key(key)}"],
+            args=[str(value), self.ttl, time.time(), self.per_chat_capacity]
+        )
+
+    async def pop(self, key: int) -> Optional[str]:
+        # GETDEL keeps a teach request from being consumed twice across replicas
+        return await self._client.getdel(self._entry_key(key))
+
+    async def contains(self, key: int) -> bool:
+        return bool(await self._client.exists(self._entry_key(key)))
+
+    async def close(self) -> None:
+        if self._owns_client:
+            await self._client.aclose()
+
+    def _entry_key(self, key: int) -> str:
+        return f"{self._prefix}:{key}"
+
+# In-memory buffer of knowledge usage increments
+class UsageCounterBuffer:
+    def __init__(self, capacity: int):
+        self._counts: Dict[int, int] = {}
+        self._pending = 0
+        self.capacity = capacity
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def add(self, knowledge_id: int, amount: int = 1) -> None:
+        # Once full, only ids already being counted keep accumulating
+        if knowledge_id not in self._counts and len(self._counts) >= self.capacity:
+            self.dropped += amount
+            return
+        self._counts[knowledge_id] = self._counts.get(knowledge_id, 0) + amount
+        self._pending += amount
+
+    def drain(self) -> Dict[int, int]:
+        counts = self._counts
+        self._counts = {}
+        self._pending = 0
+        return counts
+
+    def restore(self, counts: Dict[int, int]) -> None:
+        for knowledge_id, amount in counts.items():
+            self.add(knowledge_id, amount)
+
+# In-memory aggregation of per-user interaction deltas
+class InteractionStatBuffer:
+    def __init__(self, capacity: int):
+        self._deltas: Dict[int, Dict[str, Any]] = {}
+        self.capacity = capacity
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._deltas)
+
+    def record(self, user_id: int, username: str = None, first_name: str = None,
+               messages: int = 0, helped: int = 0, taught: int = 0) -> None:
+        delta = self._deltas.get(user_id)
+        if delta is None:
+            if len(self._deltas) >= self.capacity:
+                self.dropped += 1
+                return
+            delta = {"username": None, "first_name": None, "total_messages": 0, "times_helped_by_nemu": 0, "times_taught_nemu": 0}
+            self._deltas[user_id] = delta
+        if username is not None:
+            delta["username"] = username
+        if first_name is not None:
+            delta["first_name"] = first_name
+        delta["total_messages"] += messages
+        delta["times_helped_by_nemu"] += helped
+        delta["times_taught_nemu"] += taught
+
+    def drain(self) -> Dict[int, Dict[str, Any]]:
+        deltas = self._deltas
+        self._deltas = {}
+        return deltas
+
+    def restore(self, deltas: Dict[int, Dict[str, Any]]) -> None:
+        for user_id, delta in deltas.items():
+            current = self._deltas.get(user_id)
+            self.record(
+                user_id,
+                username=delta["username"] if current is None or current["username"] is None else None,
+                first_name=delta["first_name"] if current is None or current["first_name"] is None else None,
+                messages=delta["total_messages"],
+                helped=delta["times_helped_by_nemu"],
+                taught=delta["times_taught_nemu"]
+            )
+
+# Raised instead of waiting on a database that is known to be down
+class DatabaseUnavailable(Exception):
+    pass
+
+# Fails fast after repeated failures, letting one probe through per cool-down
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at: Optional[float] = None
+        self._last_probe = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._last_probe > self._opened_at and time.monotonic() - self._last_probe < self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - max(self._opened_at, self._last_probe) >= self.reset_timeout:
+            self._last_probe = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("✅ %s circuit closed after %.1fs", self.name, time.monotonic() - self._opened_at)
+        self._opened_at = None
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._opened_at is None and self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self.trips += 1
+            logger.warning("🔌 %s circuit opened after %s consecutive failures", self.name, self.failures)
+
+# Append-only local journal of writes made while the database is unavailable
+class WriteJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self.replay_path = f"{path}.replay"
+        self.appended = 0
+        self.replayed = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def has_entries(self) -> bool:
+        return os.path.exists(self.path) or os.path.exists(self.replay_path)
+
+    async def append(self, entries: List[Dict[str, Any]]) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self._write, self.path, self._encode(entries), "a")
+        self.appended += len(entries)
+
+    async def peek(self) -> List[Dict[str, Any]]:
+        async with self._lock:
+            return await asyncio.to_thread(lambda: self._read(self.replay_path) + self._read(self.path))
+
+    async def take(self) -> List[Dict[str, Any]]:
+        async with self._lock:
+            return await asyncio.to_thread(self._take)
+
+    async def settle(self, remaining: List[Dict[str, Any]], replayed: int) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self._settle, remaining)
+        self.replayed += replayed
+
+    def _take(self) -> List[Dict[str, Any]]:
+        # New entries queue up behind any left over from an interrupted replay
+        if os.path.exists(self.path):
+            if os.path.exists(self.replay_path):
+                with open(self.path, encoding="utf-8") as journal:
+                    self._write(self.replay_path, journal.read(), "a")
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.replay_path)
+        return self._read(self.replay_path)
+
+    def _settle(self, remaining: List[Dict[str, Any]]) -> None:
+        if not remaining:
+            if os.path.exists(self.replay_path):
+                os.remove(self.replay_path)
+            return
+        self._write(f"{self.replay_path}.tmp", self._encode(remaining), "w")
+        os.replace(f"{self.replay_path}.tmp", self.replay_path)
+
+    @staticmethod
+    def _encode(entries: List[Dict[str, Any]]) -> str:
+        return "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n" for entry in entries)
+
+    @staticmethod
+    def _read(path: str) -> List[Dict[str, Any]]:
+        if not os.path.exists(path):
+            return []
+        entries = []
+        with open(path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-append
+                    logger.warning("⚠️ Skipping unreadable journal line in %s", path)
+        return entries
+
+    @staticmethod
+    def _write(path: str, text: str, mode: str) -> None:
+        with open(path, mode, encoding="utf-8") as journal:
+            journal.write(text)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+# Token bucket refilled continuously at a fixed rate
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, reserve: float = 0) -> float:
+        self.refill()
+        missing = 1 + reserve - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+# Per-chat and global outbound limits for Telegram sends
+class TelegramRateLimiter:
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.global_bucket = TokenBucket(config["global_rate"], config["global_burst"])
+        self.dropped_actions = 0
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._blocked_until: Dict[int, float] = {}
+
+    def _chat_bucket(self, chat_id: int, is_group: bool) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if is_group:
+                bucket = TokenBucket(self.config["group_rate"], self.config["group_burst"])
+            else:
+                bucket = TokenBucket(self.config["private_rate"], self.config["private_burst"])
+            self._chat_buckets[chat_id] = bucket
+            while len(self._chat_buckets) > self.config["max_tracked_chats"]:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _wait_time(self, chat_id: int, is_group: bool, reserve: float = 0) -> float:
+        blocked = self._blocked_until.get(chat_id, 0) - time.monotonic()
+        if blocked <= 0:
+            self._blocked_until.pop(chat_id, None)
+        return max(
+            blocked,
+            self._chat_bucket(chat_id, is_group).wait_time(reserve),
+            self.global_bucket.wait_time(reserve)
+        )
+
+    async def acquire(self, chat_id: int, is_group: bool) -> None:
+        while True:
+            wait = self._wait_time(chat_id, is_group)
+            if wait <= 0:
+                self._chat_bucket(chat_id, is_group).take()
+                self.global_bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    def try_acquire(self, chat_id: int, is_group: bool, reserve: float = 0) -> bool:
+        # Low-priority sends only spend tokens above the reserve kept for replies
+        if self._wait_time(chat_id, is_group, reserve) > 0:
+            self.dropped_actions += 1
+            return False
+        self._chat_bucket(chat_id, is_group).take()
+        self.global_bucket.take()
+        return True
+
+    def block(self, chat_id: int, seconds: float) -> None:
+        self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0), time.monotonic() + seconds)
+
+# Per-chat concurrency limits with duplicate coalescing and stale-work shedding
+class ChatWorkScheduler:
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.coalesced = 0
+        self.dropped = 0
+        self._semaphores: Dict[int, asyncio.Semaphore] = {}
+        self._waiting: Dict[int, int] = {}
+        self._inflight: Dict[int, int] = {}
+        self._recent: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+
+    def is_duplicate(self, chat_id: int, query_key: str) -> bool:
+        now = time.monotonic()
+        window = self.config["coalesce_window"]
+
+        # Entries are in arrival order, so expired ones sit at the front
+        while self._recent:
+            oldest_key, seen_at = next(iter(self._recent.items()))
+            if now - seen_at < window and len(self._recent) < self.config["max_recent_queries"]:
+                break
+            del self._recent[oldest_key]
+
+        key = (chat_id, query_key)
+        if key in self._recent:
+            self.coalesced += 1
+            return True
+        self._recent[key] = now
+        return False
+
+    async def run(self, chat_id: int, work: Callable[[], Awaitable[Any]]) -> bool:
+        waiting = self._waiting.get(chat_id, 0)
+        if waiting >= self.config["max_queued_per_chat"]:
+            self.dropped += 1
+            return False
+
+        semaphore = self._semaphores.get(chat_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.config["max_inflight_per_chat"])
+            self._semaphores[chat_id] = semaphore
+
+        self._waiting[chat_id] = waiting + 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.config["max_queue_wait"])
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            self._waiting[chat_id] -= 1
+            self._forget_idle(chat_id)
+            return False
+
+        self._waiting[chat_id] -= 1
+
+        self._inflight[chat_id] = self._inflight.get(chat_id, 0) + 1
+        reply = None
+        try:
+            reply = await work()
+            return True
+        finally:
+            # A scheduled reply keeps the slot until it is sent, without holding the handler
+            if isinstance(reply, asyncio.Task) and not reply.done():
+                reply.add_done_callback(lambda _: self._release(chat_id, semaphore))
+            else:
+                self._release(chat_id, semaphore)
+
+    def _release(self, chat_id: int, semaphore: asyncio.Semaphore) -> None:
+        self._inflight[chat_id] -= 1
+        semaphore.release()
+        self._forget_idle(chat_id)
+
+    def _forget_idle(self, chat_id: int) -> None:
+        if not self._waiting.get(chat_id) and not self._inflight.get(chat_id):
+            self._semaphores.pop(chat_id, None)
+            self._waiting.pop(chat_id, None)
+            self._inflight.pop(chat_id, None)
+
+# Sends replies after a typing delay without holding the handler
+class ReplyScheduler:
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def submit(self, send: Callable[[], Awaitable[Any]], delay: float) -> Optional[asyncio.Task]:
+        # Over capacity, send right away in the caller instead of queueing more
+        if len(self._tasks) >= self.max_pending:
+            logger.debug("⏩ Reply scheduler full, sending immediately")
+            await send()
+            return None
+
+        task = asyncio.create_task(self._run(send, delay))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def shutdown(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, send: Callable[[], Awaitable[Any]], delay: float) -> None:
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await send()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error sending scheduled reply: {str(e)}")
+
+# Prometheus-style latency histogram with optional labels
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = METRIC_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            # Per-bucket counts, then +Inf count, then sum
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            self._series[key] = series
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            labels = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            label_text = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+# Time an async function into a histogram
+def timed(histogram: Histogram):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+# Record Telegram API call latency per method
+class TelegramLatencyMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started, method=type(method).__name__)
+
+# Latency histograms
+lookup_seconds = Histogram("nemu_lookup_seconds", "Knowledge lookup latency by answering tier", ("tier",))
+learn_seconds = Histogram("nemu_learn_seconds", "learn_from_reply latency")
+interaction_update_seconds = Histogram("nemu_interaction_update_seconds", "Interaction stats upsert latency")
+telegram_request_seconds = Histogram("nemu_telegram_request_seconds", "Telegram Bot API call latency by method", ("method",))
+db_acquire_seconds = Histogram("nemu_db_acquire_seconds", "Time spent waiting for a pooled database connection")
+bot.session.middleware(TelegramLatencyMiddleware())
+
 # Global variables initialization
 db_pool = None
-learning_requests = {}
-bot_messages = {}
-
-# Dummy HTTP server handler
-class DummyHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Nemu bot is alive!")
-        logger.debug("🌐 HTTP health check responded")
-
-    def do_HEAD(self):
-        self.send_response(200)
-        self.end_headers()
-
-    def log_message(self, format, *args):
-        pass
+knowledge_store = None
+index_watermark: Optional[str] = None
+learning_requests = MemoryReplyState(ChatScopedStore(
+    LEARNING_CONFIG["max_learning_requests"],
+    LEARNING_CONFIG["learning_request_ttl"],
+    LEARNING_CONFIG["max_tracked_chats"]
+))
+bot_messages = MemoryReplyState(ChatScopedStore(
+    LEARNING_CONFIG["max_bot_messages"],
+    LEARNING_CONFIG["bot_message_ttl"],
+    LEARNING_CONFIG["max_tracked_chats"]
+))
+lookup_tier_counts = {"cache": 0, "exact": 0, "fulltext": 0, "partial": 0, "miss": 0, "degraded": 0, "error": 0}
+knowledge_index = KnowledgeIndex(
+    ngram_size=KNOWLEDGE_INDEX_CONFIG["ngram_size"],
+    max_partial_checks=KNOWLEDGE_INDEX_CONFIG["max_partial_checks"]
+)
+usage_counters = UsageCounterBuffer(WRITE_BEHIND_CONFIG["max_buffered_triggers"])
+interaction_stats = InteractionStatBuffer(WRITE_BEHIND_CONFIG["max_buffered_users"])
+interaction_flush_task = None
+reply_scheduler = ReplyScheduler(REPLY_CONFIG["max_pending"])
+rate_limiter = TelegramRateLimiter(RATE_LIMIT_CONFIG)
+chat_work = ChatWorkScheduler(CHAT_WORK_CONFIG)
+inflight_handlers = 0
+event_loop_lag = 0.0
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_CONFIG["max_entries"],
+    ttl=RESPONSE_CACHE_CONFIG["ttl"],
+    negative_ttl=RESPONSE_CACHE_CONFIG["negative_ttl"]
+)
+trigger_backfill_done = False
+fulltext_index_ready = False
+db_acquire_timeouts = 0
+db_query_timeouts = 0
+db_read_pool = None
+replica_healthy = False
+replica_lag: Optional[float] = None
+replica_fallbacks = 0
+db_breaker = CircuitBreaker("Database", CIRCUIT_BREAKER_CONFIG["failure_threshold"], CIRCUIT_BREAKER_CONFIG["reset_timeout"])
+write_journal = WriteJournal(JOURNAL_CONFIG["path"])
+recent_writes = BoundedStore(REPLICA_CONFIG["max_recent_writes"], REPLICA_CONFIG["read_your_writes_ttl"])
+media_file_ids: Dict[str, str] = {}
+background_tasks = set()
+
+# Errors that mean the database itself is unreachable, locked or too slow
+DB_CONNECTION_ERRORS = (aiomysql.OperationalError, sqlite3.OperationalError, asyncio.TimeoutError, OSError)
+
+# Take a connection from a pool within a deadline, recording the wait
+async def acquire_connection(pool):
+    global db_acquire_timeouts
+
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(pool.acquire(), DATABASE_TIMEOUTS["acquire"])
+    except asyncio.TimeoutError:
+        db_acquire_timeouts += 1
+        raise
+    finally:
+        db_acquire_seconds.observe(time.perf_counter() - started)
+
+# Check whether a read may be served by the replica
+def replica_usable(trigger_key: Optional[str] = None) -> bool:
+    if db_read_pool is None or not replica_healthy:
+        return False
+    # Keys taught recently are read back from the primary
+    return trigger_key is None or trigger_key not in recent_writes
+
+# Stop routing reads to the replica until the next health check
+def mark_replica_unhealthy(reason: str) -> None:
+    global replica_healthy
+
+    if replica_healthy:
+        logger.warning("⚠️ Read replica disabled, using primary: %s", reason)
+    replica_healthy = False
+
+# Check whether the knowledge store can be used right now
+def database_available() -> bool:
+    return knowledge_store is not None and knowledge_store.available
+
+# Acquire a pooled database connection; reads prefer a healthy replica
+@asynccontextmanager
+async def db_acquire(read: bool = False, trigger_key: Optional[str] = None):
+    global replica_fallbacks
+
+    pool = db_pool
+    conn = None
+    if pool is None:
+        raise DatabaseUnavailable("database not connected")
+    if read and replica_usable(trigger_key):
+        try:
+            conn = await acquire_connection(db_read_pool)
+            pool = db_read_pool
+        except Exception as e:
+            replica_fallbacks += 1
+            mark_replica_unhealthy(str(e) or type(e).__name__)
+
+    if conn is None:
+        if not db_breaker.allow():
+            raise DatabaseUnavailable("database circuit open")
+        try:
+            conn = await acquire_connection(pool)
+        except DB_CONNECTION_ERRORS:
+            db_breaker.record_failure()
+            raise
 
-# Start dummy HTTP server
-def start_dummy_server() -> None:
     try:
-        port = int(os.environ.get("PORT", 10000))
-        server = HTTPServer(("0.0.0.0", port), DummyHandler)
-        logger.info(f"🌐 Dummy HTTP server started on port {port}")
-        server.serve_forever()
-    except Exception as e:
-        logger.error(f"❌ Failed to start HTTP server: {e}")
+        yield conn
+    except DB_CONNECTION_ERRORS as e:
+        if pool is db_read_pool:
+            replica_fallbacks += 1
+            mark_replica_unhealthy(str(e) or type(e).__name__)
+        else:
+            db_breaker.record_failure()
+        raise
+    else:
+        if pool is db_pool:
+            db_breaker.record_success()
+    finally:
+        pool.release(conn)
+
+# Execute a statement within a deadline
+async def db_execute(cursor, sql: str, args=None, timeout: Optional[float] = None):
+    global db_query_timeouts
+
+    try:
+        return await asyncio.wait_for(cursor.execute(sql, args), timeout or DATABASE_TIMEOUTS["query"])
+    except asyncio.TimeoutError:
+        # The connection is mid-statement, so close it and let the pool drop it
+        db_query_timeouts += 1
+        cursor.connection.close()
+        logger.warning("⏱️ Database statement exceeded %ss deadline", timeout or DATABASE_TIMEOUTS["query"])
+        raise
+
+# Open pooled connections up to minsize and check they respond
+async def prewarm_db_pool():
+    async def ping_connection():
+        async with db_acquire() as conn:
+            await conn.ping(reconnect=False)
+
+    await asyncio.gather(*(ping_connection() for _ in range(DATABASE_CONFIG["minsize"])))
+    logger.info("🔥 Database pool pre-warmed: %s/%s connections", db_pool.size, db_pool.maxsize)
+
+# Run a coroutine in the background and keep a reference to it
+def start_background_task(coro, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Respond to plain liveness probes
+async def handle_root(request: web.Request) -> web.Response:
+    logger.debug("🌐 HTTP health check responded")
+    return web.Response(text="Nemu bot is alive!")
+
+# Measure event loop lag by how late a periodic sleep wakes up
+async def monitor_event_loop_lag():
+    global event_loop_lag
+
+    interval = HEALTH_CONFIG["loop_lag_interval"]
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag = max(0.0, loop.time() - started - interval)
+
+# Collect subsystem state for health reporting
+def collect_health_snapshot() -> Dict[str, Any]:
+    database = knowledge_store.health() if knowledge_store is not None else {"connected": False}
+    database["backend"] = STORAGE_BACKEND
+
+    replica = {"configured": db_read_pool is not None}
+    if db_read_pool is not None:
+        replica.update({
+            "healthy": replica_healthy,
+            "lag": replica_lag,
+            "fallbacks": replica_fallbacks,
+            "size": db_read_pool.size,
+            "free": db_read_pool.freesize
+        })
+
+    return {
+        "mode": RUN_MODE,
+        "database": database,
+        "replica": replica,
+        "circuit": {"state": db_breaker.state, "trips": db_breaker.trips, "rejected": db_breaker.rejected},
+        "journal": {"pending": write_journal.has_entries, "appended": write_journal.appended, "replayed": write_journal.replayed},
+        "inflight_handlers": inflight_handlers,
+        "event_loop_lag": round(event_loop_lag, 4),
+        "response_cache": response_cache.stats(),
+        "lookup_tiers": dict(lookup_tier_counts),
+        "knowledge_index": {"loaded": knowledge_index.loaded, "triggers": len(knowledge_index)},
+        "write_behind": {
+            "usage_increments": usage_counters.pending,
+            "interaction_users": interaction_stats.pending,
+            "dropped": usage_counters.dropped + interaction_stats.dropped,
+            "scheduled_replies": reply_scheduler.pending
+        }
+    }
+
+# Decide readiness from the health snapshot
+def readiness_problems(snapshot: Dict[str, Any]) -> list:
+    problems = []
+    database = snapshot["database"]
+
+    if not database["connected"]:
+        problems.append("database unavailable")
+    elif "max" in database and database["size"] >= database["max"] and database["free"] < HEALTH_CONFIG["min_free_connections"]:
+        problems.append("database pool saturated")
+
+    if snapshot["event_loop_lag"] > HEALTH_CONFIG["max_loop_lag"]:
+        problems.append("event loop lagging")
+
+    return problems
+
+# Report process health
+async def handle_healthz(request: web.Request) -> web.Response:
+    snapshot = collect_health_snapshot()
+    snapshot["status"] = "ok"
+    return web.json_response(snapshot)
+
+# Report whether the bot can serve traffic
+async def handle_readyz(request: web.Request) -> web.Response:
+    snapshot = collect_health_snapshot()
+    problems = readiness_problems(snapshot)
+    snapshot["ready"] = not problems
+    snapshot["problems"] = problems
+    if problems:
+        logger.warning(f"⚠️ Readiness check failed: {', '.join(problems)}")
+    return web.json_response(snapshot, status=503 if problems else 200)
+
+# Render histograms and health gauges in Prometheus text format
+def render_metrics() -> str:
+    lines = []
+    for histogram in (lookup_seconds, learn_seconds, interaction_update_seconds, telegram_request_seconds, db_acquire_seconds):
+        lines.extend(histogram.render())
+
+    snapshot = collect_health_snapshot()
+    database = snapshot["database"]
+    cache = snapshot["response_cache"]
+    write_behind = snapshot["write_behind"]
+    replica = snapshot["replica"]
+    gauges = {
+        "nemu_db_pool_size": database.get("size", 0),
+        "nemu_db_pool_free": database.get("free", 0),
+        "nemu_db_pool_max": database.get("max", 0),
+        "nemu_inflight_handlers": snapshot["inflight_handlers"],
+        "nemu_event_loop_lag_seconds": snapshot["event_loop_lag"],
+        "nemu_response_cache_size": cache["size"],
+        "nemu_response_cache_hits_total": cache["hits"] + cache["negative_hits"],
+        "nemu_response_cache_misses_total": cache["misses"],
+        "nemu_response_cache_evictions_total": cache["evictions"],
+        "nemu_pending_usage_increments": write_behind["usage_increments"],
+        "nemu_pending_interaction_users": write_behind["interaction_users"],
+        "nemu_scheduled_replies": write_behind["scheduled_replies"],
+        "nemu_log_records_dropped_total": log_rate_limiter.dropped,
+        "nemu_typing_actions_dropped_total": rate_limiter.dropped_actions,
+        "nemu_chat_work_coalesced_total": chat_work.coalesced,
+        "nemu_chat_work_dropped_total": chat_work.dropped,
+        "nemu_db_acquire_timeouts_total": db_acquire_timeouts,
+        "nemu_db_query_timeouts_total": db_query_timeouts,
+        "nemu_db_replica_healthy": int(replica.get("healthy", False)),
+        "nemu_db_replica_lag_seconds": replica.get("lag") or 0,
+        "nemu_db_replica_fallbacks_total": replica.get("fallbacks", 0),
+        "nemu_db_circuit_open": int(db_breaker.is_open),
+        "nemu_db_circuit_trips_total": db_breaker.trips,
+        "nemu_db_circuit_rejected_total": db_breaker.rejected,
+        "nemu_journal_appended_total": write_journal.appended,
+        "nemu_journal_replayed_total": write_journal.replayed,
+        "nemu_write_behind_dropped_total": write_behind["dropped"]
+    }
+    for name, value in gauges.items():
+        metric_type = "counter" if name.endswith("_total") else "gauge"
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+# Expose metrics for scraping
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=render_metrics().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+# Build the HTTP application serving health checks and webhook updates
+def create_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/", handle_root)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/readyz", handle_readyz)
+    app.router.add_get("/metrics", handle_metrics)
+
+    if RUN_MODE == "webhook":
+        # Unverified updates could teach arbitrary answers
+        if not WEBHOOK_SECRET:
+            raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+
+        # Updates are acknowledged immediately and processed concurrently
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
+
+    return app
+
+# Start HTTP server on the bot's event loop
+async def start_web_server() -> web.AppRunner:
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    logger.info(f"🌐 HTTP server started on port {PORT} ({RUN_MODE} mode)")
+    return runner
+
+# Register webhook with Telegram
+async def setup_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required in webhook mode")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info("✅ Webhook registered")
+
+# Wait until the process is asked to stop
+async def wait_for_shutdown_signal():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    await stop_event.wait()
 
 # Extract user information from message
 def extract_user_info(msg: Message) -> Dict[str, any]:
-    logger.debug("🔍 Extracting user information")
     u = msg.from_user
     c = msg.chat
     info = {
@@ -281,35 +1676,20 @@ def extract_user_info(msg: Message) -> Dict[str, any]:
         "chat_id": c.id,
         "chat_type": c.type,
         "chat_title": c.title or c.first_name or "",
-        "chat_username": f"@{c.username}" if c.username else "No Username",
-        "chat_link": f"https://t.me/{c.username}" if c.username else "No Link",
+        "chat_username": c.username,
     }
-    logger.info(
-        f"📑 User info extracted: {info['full_name']} (@{info['username']}) "
-        f"[ID: {info['user_id']}] in {info['chat_title']} [{info['chat_id']}] {info['chat_link']}"
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("📑 User info extracted: %s", UserLogDetail(info), extra=info)
     return info
 
-# Log messages with user info
-def log_with_user_info(level: str, message: str, user_info: Dict[str, any]) -> None:
-    user_detail = (
-        f"👤 {user_info['full_name']} (@{user_info['username']}) "
-        f"[ID: {user_info['user_id']}] | "
-        f"💬 {user_info['chat_title']} [{user_info['chat_id']}] "
-        f"({user_info['chat_type']}) {user_info['chat_link']}"
-    )
-    full_message = f"{message} | {user_detail}"
-
-    if level.upper() == "INFO":
-        logger.info(full_message)
-    elif level.upper() == "DEBUG":
-        logger.debug(full_message)
-    elif level.upper() == "WARNING":
-        logger.warning(full_message)
-    elif level.upper() == "ERROR":
-        logger.error(full_message)
-    else:
-        logger.info(full_message)
+# Log messages with user info, formatting nothing below the active level
+def log_with_user_info(level: str, message: str, user_info: Dict[str, any], *args) -> None:
+    levelno = logging.getLevelName(level.upper())
+    if not isinstance(levelno, int):
+        levelno = logging.INFO
+    if not logger.isEnabledFor(levelno):
+        return
+    logger.log(levelno, message + " | %s", *args, UserLogDetail(user_info), extra=user_info)
 
 # Validate database URL format
 def validate_database_url(database_url: str) -> bool:
@@ -362,7 +1742,7 @@ def contains_nemu_trigger(text: str) -> bool:
     text_lower = text.lower()
     contains_trigger = "nemu" in text_lower
     
-    logger.debug(f"🔍 Trigger check: {'✅ Found' if contains_trigger else '❌ Not found'}")
+    logger.debug("🔍 Trigger check: %s", "✅ Found" if contains_trigger else "❌ Not found")
     return contains_trigger
 
 # Extract query from Nemu message
@@ -375,10 +1755,75 @@ def extract_query_from_nemu_message(text: str) -> str:
     text = re.sub(r'[,\s]*$', '', text)
 
     extracted_query = text.strip()
-    logger.debug(f"🔤 Query extraction: '{original_text}' -> '{extracted_query}'")
+    logger.debug("🔤 Query extraction: '%s' -> '%s'", original_text, extracted_query)
     
     return extracted_query
 
+# Normalize trigger text for index lookups
+def normalize_trigger(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+# Compute 64-bit hash of a normalized trigger
+def trigger_hash(trigger_key: str) -> int:
+    digest = hashlib.blake2b(trigger_key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+# Switch reply tracking to the shared store when configured
+async def init_reply_state() -> bool:
+    global learning_requests, bot_messages
+
+    if not REDIS_URL:
+        logger.info("🧠 Using in-memory reply tracking")
+        return False
+
+    if aioredis is None:
+        logger.warning("⚠️ REDIS_URL set but redis package not installed, using in-memory reply tracking")
+        return False
+
+    try:
+        client = aioredis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_connect_timeout=STATE_CONFIG["connect_timeout"]
+        )
+        await client.ping()
+    except Exception as e:
+        logger.error(f"❌ Failed to connect to state store, using in-memory reply tracking: {str(e)}")
+        return False
+
+    learning_requests = RedisReplyState(
+        client, "learn", LEARNING_CONFIG["max_learning_requests"], LEARNING_CONFIG["learning_request_ttl"], owns_client=True
+    )
+    bot_messages = RedisReplyState(
+        client, "msg", LEARNING_CONFIG["max_bot_messages"], LEARNING_CONFIG["bot_message_ttl"]
+    )
+    logger.info("✅ Shared reply tracking state connected")
+    return True
+
+# Create a connection pool for a database URL
+async def create_db_pool(database_url: str):
+    parsed = urlparse.urlparse(database_url)
+
+    # SSL configuration if needed
+    ssl_config = None
+    if 'ssl-mode=REQUIRED' in database_url or 'sslmode=require' in database_url:
+        import ssl
+        ssl_config = ssl.create_default_context()
+        ssl_config.check_hostname = False
+        ssl_config.verify_mode = ssl.CERT_NONE
+        logger.debug("🔐 SSL configured for database")
+
+    return await aiomysql.create_pool(
+        host=parsed.hostname,
+        port=parsed.port or 3306,
+        user=parsed.username,
+        password=parsed.password,
+        db=parsed.path[1:] if parsed.path else None,
+        ssl=ssl_config,
+        autocommit=True,
+        **DATABASE_CONFIG
+    )
+
 # Initialize database connection pool
 async def init_database():
     global db_pool
@@ -409,34 +1854,20 @@ async def init_database():
             logger.debug(f"👤 Database user: {parsed.username}")
             logger.debug(f"📦 Database name: {parsed.path[1:] if parsed.path else 'Not specified'}")
 
-            # SSL configuration if needed
-            ssl_config = None
-            if 'ssl-mode=REQUIRED' in DATABASE_URL or 'sslmode=require' in DATABASE_URL:
-                import ssl
-                ssl_config = ssl.create_default_context()
-                ssl_config.check_hostname = False
-                ssl_config.verify_mode = ssl.CERT_NONE
-                logger.debug("🔐 SSL configured for database")
-
-            db_pool = await aiomysql.create_pool(
-                host=parsed.hostname,
-                port=parsed.port or 3306,
-                user=parsed.username,
-                password=parsed.password,
-                db=parsed.path[1:] if parsed.path else None,
-                ssl=ssl_config,
-                autocommit=True,
-                **DATABASE_CONFIG
-            )
+            db_pool = await create_db_pool(DATABASE_URL)
 
             logger.debug("🧪 Testing database connection...")
-            async with db_pool.acquire() as conn:
+            async with db_acquire() as conn:
                 async with conn.cursor() as cursor:
                     await cursor.execute("SELECT 1 AS test")
                     result = await cursor.fetchone()
                     logger.debug(f"✅ Database test result: {result}")
 
+            await prewarm_db_pool()
             await create_tables()
+            await load_knowledge_index()
+            await load_media_cache()
+            start_background_task(backfill_trigger_hashes(), "trigger-backfill")
             logger.info("🎉 Database connection established successfully!")
             return True
 
@@ -467,7 +1898,7 @@ async def create_tables():
         return
 
     try:
-        async with db_pool.acquire() as conn:
+        async with db_acquire() as conn:
             async with conn.cursor() as cursor:
                 logger.debug("🏗️ Creating nemu_global_knowledge table...")
                 await cursor.execute("""
@@ -483,12 +1914,19 @@ async def create_tables():
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                         usage_count INT DEFAULT 0,
                         global_usage_count INT DEFAULT 0,
+                        trigger_normalized TEXT NULL,
+                        trigger_hash BIGINT UNSIGNED NULL,
                         INDEX idx_trigger (trigger_message(100)),
-                        FULLTEXT idx_message_fulltext (trigger_message, response)
+                        UNIQUE INDEX idx_trigger_hash (trigger_hash),
+                        FULLTEXT idx_message_fulltext (trigger_message, response),
+                        FULLTEXT idx_trigger_fulltext (trigger_message),
+                        INDEX idx_updated_at (updated_at)
                     )
                 """)
                 logger.debug("✅ nemu_global_knowledge table created/verified")
 
+                await migrate_knowledge_table(cursor)
+
                 logger.debug("🏗️ Creating nemu_interactions table...")
                 await cursor.execute("""
                     CREATE TABLE IF NOT EXISTS nemu_interactions (
@@ -503,179 +1941,1420 @@ async def create_tables():
                     )
                 """)
                 logger.debug("✅ nemu_interactions table created/verified")
+
+                logger.debug("🏗️ Creating nemu_media_cache table...")
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS nemu_media_cache (
+                        url VARCHAR(512) PRIMARY KEY,
+                        file_id VARCHAR(255) NOT NULL,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                    )
+                """)
+                logger.debug("✅ nemu_media_cache table created/verified")
+
+                logger.debug("🏗️ Creating nemu_replica_heartbeat table...")
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS nemu_replica_heartbeat (
+                        id TINYINT PRIMARY KEY,
+                        beat DATETIME(6) NOT NULL
+                    )
+                """)
+                logger.debug("✅ nemu_replica_heartbeat table created/verified")
                 
                 logger.info("🎉 All database tables created/verified successfully!")
     except Exception as e:
         logger.error(f"❌ Error creating tables: {str(e)}")
         raise
 
-# Learn from user reply to bot
-async def learn_from_reply(chat_id: int, user_id: int, username: str, chat_title: str, original_query: str, teaching_response: str):
-    global db_pool
-
-    logger.info(f"🌍 GLOBAL learning attempt - User: {username} ({user_id})")
+# Add normalized trigger columns and indexes to older tables
+async def migrate_knowledge_table(cursor):
+    await cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'nemu_global_knowledge'
+        AND COLUMN_NAME IN ('trigger_normalized', 'trigger_hash')
+    """)
+    existing_columns = {row[0] for row in await cursor.fetchall()}
+
+    if "trigger_normalized" not in existing_columns:
+        logger.info("🛠️ Adding trigger_normalized column")
+        await cursor.execute("""
+            ALTER TABLE nemu_global_knowledge
+            ADD COLUMN trigger_normalized TEXT NULL, ALGORITHM=INPLACE, LOCK=NONE
+        """)
+
+    if "trigger_hash" not in existing_columns:
+        logger.info("🛠️ Adding trigger_hash column and unique index")
+        await cursor.execute("""
+            ALTER TABLE nemu_global_knowledge
+            ADD COLUMN trigger_hash BIGINT UNSIGNED NULL, ALGORITHM=INPLACE, LOCK=NONE
+        """)
+        await cursor.execute("""
+            ALTER TABLE nemu_global_knowledge
+            ADD UNIQUE INDEX idx_trigger_hash (trigger_hash), ALGORITHM=INPLACE, LOCK=NONE
+        """)
+
+    # A FULLTEXT build cannot run with LOCK=NONE, so it is left to the migrate-fulltext command
+    if not await detect_trigger_fulltext_index(cursor):
+        logger.warning("⚠️ Trigger fulltext index missing, fulltext matching is off until `python nemu.py migrate-fulltext` runs")
+
+    # Periodic index refreshes select rows by updated_at
+    await cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'nemu_global_knowledge'
+        AND INDEX_NAME = 'idx_updated_at'
+        LIMIT 1
+    """)
+    if not await cursor.fetchone():
+        logger.info("🛠️ Adding updated_at index")
+        await cursor.execute("""
+            ALTER TABLE nemu_global_knowledge
+            ADD INDEX idx_updated_at (updated_at), ALGORITHM=INPLACE, LOCK=NONE
+        """)
+
+# Check whether MATCH(trigger_message) has its FULLTEXT index yet
+async def detect_trigger_fulltext_index(cursor) -> bool:
+    global fulltext_index_ready
+
+    await cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'nemu_global_knowledge'
+        AND INDEX_NAME = 'idx_trigger_fulltext'
+        LIMIT 1
+    """)
+    fulltext_index_ready = bool(await cursor.fetchone())
+    return fulltext_index_ready
+
+# One-off migration building the trigger FULLTEXT index on an existing table
+async def add_trigger_fulltext_index() -> None:
+    async with db_acquire() as conn:
+        async with conn.cursor() as cursor:
+            if await detect_trigger_fulltext_index(cursor):
+                logger.info("✅ Trigger fulltext index already exists")
+                return
+
+            # InnoDB builds FULLTEXT in place but blocks writes while it runs
+            logger.info("🛠️ Adding trigger fulltext index, writes wait until it finishes")
+            started = time.monotonic()
+            await cursor.execute("""
+                ALTER TABLE nemu_global_knowledge
+                ADD FULLTEXT INDEX idx_trigger_fulltext (trigger_message), ALGORITHM=INPLACE, LOCK=SHARED
+            """)
+            await detect_trigger_fulltext_index(cursor)
+            logger.info(f"✅ Trigger fulltext index added in {time.monotonic() - started:.2f}s")
+
+# Backfill trigger hashes for existing rows in small batches
+async def backfill_trigger_hashes():
+    global trigger_backfill_done
 
     if not db_pool:
-        logger.warning("⚠️ Database not available for learning")
-        return "failed"
+        return
+
+    logger.info("🔁 Starting trigger hash backfill")
+    last_id = 0
+    updated = 0
+    skipped = 0
 
     try:
-        async with db_pool.acquire() as conn:
+        while True:
+            async with db_acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        SELECT id, trigger_message FROM nemu_global_knowledge
+                        WHERE id > %s AND trigger_hash IS NULL
+                        ORDER BY id
+                        LIMIT %s
+                    """, (last_id, BACKFILL_CONFIG["batch_size"]))
+                    rows = await cursor.fetchall()
+
+                    if not rows:
+                        break
+
+                    # Duplicate triggers keep a NULL hash; UPDATE IGNORE skips them
+                    case_normalized = []
+                    case_hash = []
+                    ids = []
+                    for row_id, trigger_message in rows:
+                        trigger_key = normalize_trigger(trigger_message)
+                        case_normalized.extend((row_id, trigger_key))
+                        case_hash.extend((row_id, trigger_hash(trigger_key)))
+                        ids.append(row_id)
+
+                    whens = " ".join(["WHEN %s THEN %s"] * len(rows))
+                    placeholders = ", ".join(["%s"] * len(ids))
+                    await cursor.execute(f"""
+                        UPDATE IGNORE nemu_global_knowledge
+                        SET trigger_normalized = CASE id {whens} END,
+                            trigger_hash = CASE id {whens} END
+                        WHERE id IN ({placeholders})
+                    """, (*case_normalized, *case_hash, *ids))
+
+                    updated += cursor.rowcount
+                    skipped += len(rows) - cursor.rowcount
+                    last_id = rows[-1][0]
+
+            await asyncio.sleep(BACKFILL_CONFIG["pause"])
+
+        trigger_backfill_done = True
+        logger.info(f"✅ Trigger hash backfill complete: {updated} updated, {skipped} duplicates skipped")
+    except asyncio.CancelledError:
+        logger.info("⏹️ Trigger hash backfill cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error during trigger hash backfill: {str(e)}")
+
+# Build exact-match WHERE clause for a trigger
+def exact_trigger_clause(query: str) -> Tuple[str, tuple]:
+    if trigger_backfill_done:
+        trigger_key = normalize_trigger(query)
+        return "trigger_hash = %s AND trigger_normalized = %s", (trigger_hash(trigger_key), trigger_key)
+    return "LOWER(trigger_message) = LOWER(%s)", (query,)
+
+# MySQL knowledge storage on the shared aiomysql pool
+class MySQLKnowledgeStore:
+    @property
+    def available(self) -> bool:
+        return db_pool is not None and not db_breaker.is_open
+
+    @property
+    def fulltext_ready(self) -> bool:
+        return fulltext_index_ready
+
+    def health(self) -> Dict[str, Any]:
+        database = {"connected": db_pool is not None, "fulltext_index": fulltext_index_ready}
+        if db_pool is not None:
+            database.update({
+                "size": db_pool.size,
+                "free": db_pool.freesize,
+                "max": db_pool.maxsize
+            })
+        return database
+
+    async def recover(self) -> None:
+        if db_pool is None:
+            if await init_database():
+                await init_read_replica()
+        elif db_breaker.is_open:
+            await probe_database()
+        elif not fulltext_index_ready:
+            # Picks up a migrate-fulltext run without restarting
+            async with db_acquire() as conn:
+                async with conn.cursor() as cursor:
+                    if await detect_trigger_fulltext_index(cursor):
+                        logger.info("✅ Trigger fulltext index found, fulltext matching enabled")
+
+    async def write_knowledge(self, chat_id: int, user_id: int, username: str, chat_title: str,
+                              original_query: str, teaching_response: str, trigger_key: str) -> Tuple[int, str]:
+        async with db_acquire() as conn:
             async with conn.cursor() as cursor:
-                logger.debug(f"🔍 Checking for existing GLOBAL knowledge")
-                await cursor.execute("""
-                    SELECT id, response FROM nemu_global_knowledge 
-                    WHERE LOWER(trigger_message) = LOWER(%s)
+                # One upsert on idx_trigger_hash, so concurrent teaches of a trigger cannot collide;
+                # LAST_INSERT_ID(id) makes lastrowid report the existing row when it is updated
+                await db_execute(cursor, """
+                    INSERT INTO nemu_global_knowledge (trigger_message, response, taught_by_user_id, taught_by_username, taught_in_chat_id, taught_in_chat_title, trigger_normalized, trigger_hash)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) AS new_data
+                    ON DUPLICATE KEY UPDATE
+                    id = LAST_INSERT_ID(nemu_global_knowledge.id),
+                    response = new_data.response,
+                    taught_by_user_id = new_data.taught_by_user_id,
+                    taught_by_username = new_data.taught_by_username,
+                    taught_in_chat_id = new_data.taught_in_chat_id,
+                    taught_in_chat_title = new_data.taught_in_chat_title,
+                    updated_at = CURRENT_TIMESTAMP
+                """, (original_query, teaching_response, user_id, username, chat_id, chat_title, trigger_key, trigger_hash(trigger_key)))
+
+                # MySQL counts one affected row for an insert and two for an update
+                action = "learned" if cursor.rowcount == 1 else "updated"
+                logger.info("%s GLOBAL knowledge", "➕ Added new" if action == "learned" else "🔄 Updated existing")
+                return cursor.lastrowid, action
+
+    async def lookup(self, query: str, trigger_key: str, include_exact: bool, include_fulltext: bool,
+                     include_partial: bool) -> Optional[Tuple[int, str, str]]:
+        sql, args = build_cascade_lookup(query, include_exact, include_fulltext, include_partial)
+        on_replica = replica_usable(trigger_key)
+        try:
+            result = await self._fetch_lookup(sql, args, trigger_key)
+        except DB_CONNECTION_ERRORS:
+            # The failed replica is now marked unhealthy, so the retry reads the primary
+            if not on_replica or replica_usable(trigger_key):
+                raise
+            logger.debug("🔁 Replica lookup failed, retrying on the primary")
+            result = await self._fetch_lookup(sql, args, trigger_key)
+
+        if result and result[0]:
+            return result[1], result[0], LOOKUP_TIERS[result[2]]
+        return None
+
+    async def _fetch_lookup(self, sql: str, args: tuple, trigger_key: str) -> Optional[tuple]:
+        async with db_acquire(read=True, trigger_key=trigger_key) as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, sql, args)
+                return await cursor.fetchone()
+
+    async def iter_knowledge(self, batch_size: int, updated_since: Optional[str] = None):
+        where_clause = "WHERE updated_at >= %s" if updated_since else ""
+        async with db_acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(f"""
+                    SELECT id, trigger_message, response, global_usage_count
+                    FROM nemu_global_knowledge
+                    {where_clause}
                     ORDER BY global_usage_count DESC, updated_at DESC
-                    LIMIT 1
-                """, (original_query,))
+                """, (updated_since,) if updated_since else None)
 
-                existing = await cursor.fetchone()
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
 
-                if existing:
-                    logger.info(f"🔄 Updating existing GLOBAL knowledge")
-                    await cursor.execute("""
-                        UPDATE nemu_global_knowledge 
-                        SET response = %s, taught_by_user_id = %s, taught_by_username = %s, 
-                            taught_in_chat_id = %s, taught_in_chat_title = %s, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = %s
-                    """, (teaching_response, user_id, username, chat_id, chat_title, existing[0]))
-                    action = "updated"
-                else:
-                    logger.info("➕ Adding new GLOBAL knowledge")
-                    await cursor.execute("""
-                        INSERT INTO nemu_global_knowledge (trigger_message, response, taught_by_user_id, taught_by_username, taught_in_chat_id, taught_in_chat_title)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (original_query, teaching_response, user_id, username, chat_id, chat_title))
-                    action = "learned"
+    async def watermark(self, overlap: int) -> str:
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, "SELECT CAST(CURRENT_TIMESTAMP - INTERVAL %s SECOND AS CHAR)", (overlap,))
+                return (await cursor.fetchone())[0]
 
-                logger.debug(f"📊 Updating user interaction stats")
+    async def iter_snapshot_rows(self, batch_size: int):
+        async with db_acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cursor:
                 await cursor.execute("""
-                    INSERT INTO nemu_interactions (user_id, username, times_taught_nemu)
-                    VALUES (%s, %s, 1) AS new_data
+                    SELECT id, trigger_message, response, taught_by_user_id, taught_by_username,
+                           taught_in_chat_id, taught_in_chat_title, usage_count, global_usage_count,
+                           CAST(created_at AS CHAR), CAST(updated_at AS CHAR)
+                    FROM nemu_global_knowledge
+                    ORDER BY id
+                """)
+
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def import_snapshot_rows(self, rows: List[tuple]) -> None:
+        # Snapshot ids are not kept, so rows only ever collide on the trigger hash
+        values = []
+        for row in rows:
+            trigger_key = normalize_trigger(row[1])
+            values.extend((*row[1:], trigger_key, trigger_hash(trigger_key)))
+        placeholders = ", ".join(
+            ["(%s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP), COALESCE(%s, CURRENT_TIMESTAMP), %s, %s)"] * len(rows)
+        )
+
+        # The newer copy of a trigger wins; updated_at is assigned last so the comparison sees the old value
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, f"""
+                    INSERT INTO nemu_global_knowledge (trigger_message, response, taught_by_user_id, taught_by_username,
+                        taught_in_chat_id, taught_in_chat_title, usage_count, global_usage_count, created_at, updated_at,
+                        trigger_normalized, trigger_hash)
+                    VALUES {placeholders} AS new_data
                     ON DUPLICATE KEY UPDATE
-                    username = new_data.username,
-                    times_taught_nemu = nemu_interactions.times_taught_nemu + 1,
+                    response = IF(new_data.updated_at >= nemu_global_knowledge.updated_at, new_data.response, nemu_global_knowledge.response),
+                    usage_count = GREATEST(nemu_global_knowledge.usage_count, new_data.usage_count),
+                    global_usage_count = GREATEST(nemu_global_knowledge.global_usage_count, new_data.global_usage_count),
+                    updated_at = GREATEST(nemu_global_knowledge.updated_at, new_data.updated_at)
+                """, values, timeout=DATABASE_TIMEOUTS["query"] * 6)
+
+    async def add_usage(self, counts: Dict[int, int]) -> None:
+        whens = " ".join(["WHEN %s THEN %s"] * len(counts))
+        case_args = [value for item in counts.items() for value in item]
+        ids = list(counts)
+        placeholders = ", ".join(["%s"] * len(ids))
+
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, f"""
+                    UPDATE nemu_global_knowledge
+                    SET usage_count = usage_count + CASE id {whens} END,
+                        global_usage_count = global_usage_count + CASE id {whens} END,
+                        updated_at = updated_at
+                    WHERE id IN ({placeholders})
+                """, (*case_args, *case_args, *ids))
+
+    async def upsert_interactions(self, deltas: Dict[int, Dict[str, Any]]) -> None:
+        rows = []
+        for user_id, delta in deltas.items():
+            rows.extend((
+                user_id,
+                delta["username"],
+                delta["first_name"],
+                delta["total_messages"],
+                delta["times_helped_by_nemu"],
+                delta["times_taught_nemu"]
+            ))
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(deltas))
+
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, f"""
+                    INSERT INTO nemu_interactions (user_id, username, first_name, total_messages, times_helped_by_nemu, times_taught_nemu)
+                    VALUES {placeholders} AS new_data
+                    ON DUPLICATE KEY UPDATE
+                    username = COALESCE(new_data.username, nemu_interactions.username),
+                    first_name = COALESCE(new_data.first_name, nemu_interactions.first_name),
+                    total_messages = nemu_interactions.total_messages + new_data.total_messages,
+                    times_helped_by_nemu = nemu_interactions.times_helped_by_nemu + new_data.times_helped_by_nemu,
+                    times_taught_nemu = nemu_interactions.times_taught_nemu + new_data.times_taught_nemu,
                     last_interaction = CURRENT_TIMESTAMP
-                """, (user_id, username))
+                """, rows)
+
+    async def load_media(self) -> Dict[str, str]:
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT url, file_id FROM nemu_media_cache")
+                return dict(await cursor.fetchall())
+
+    async def store_media(self, url: str, file_id: str) -> None:
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, """
+                    INSERT INTO nemu_media_cache (url, file_id) VALUES (%s, %s) AS new_data
+                    ON DUPLICATE KEY UPDATE file_id = new_data.file_id
+                """, (url, file_id))
+
+    async def close(self) -> None:
+        for pool, name in ((db_read_pool, "Read replica"), (db_pool, "Database")):
+            if pool is None:
+                continue
+            try:
+                pool.close()
+                await pool.wait_closed()
+                logger.info("✅ %s pool closed", name)
+            except Exception as e:
+                logger.error(f"❌ Error closing {name.lower()} pool: {str(e)}")
+
+# Embedded SQLite knowledge storage in WAL mode; statements run on worker threads
+class SQLiteKnowledgeStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS nemu_global_knowledge (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trigger_message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            taught_by_user_id INTEGER NOT NULL,
+            taught_by_username TEXT,
+            taught_in_chat_id INTEGER NOT NULL,
+            taught_in_chat_title TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            usage_count INTEGER DEFAULT 0,
+            global_usage_count INTEGER DEFAULT 0,
+            trigger_normalized TEXT NOT NULL UNIQUE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_knowledge_updated_at ON nemu_global_knowledge (updated_at);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS nemu_knowledge_fts USING fts5(
+            trigger_message, content='nemu_global_knowledge', content_rowid='id'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS nemu_knowledge_fts_insert AFTER INSERT ON nemu_global_knowledge BEGIN
+            INSERT INTO nemu_knowledge_fts (rowid, trigger_message) VALUES (new.id, new.trigger_message);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS nemu_knowledge_fts_delete AFTER DELETE ON nemu_global_knowledge BEGIN
+            INSERT INTO nemu_knowledge_fts (nemu_knowledge_fts, rowid, trigger_message) VALUES ('delete', old.id, old.trigger_message);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS nemu_knowledge_fts_update AFTER UPDATE OF trigger_message ON nemu_global_knowledge BEGIN
+            INSERT INTO nemu_knowledge_fts (nemu_knowledge_fts, rowid, trigger_message) VALUES ('delete', old.id, old.trigger_message);
+            INSERT INTO nemu_knowledge_fts (rowid, trigger_message) VALUES (new.id, new.trigger_message);
+        END;
+
+        CREATE TABLE IF NOT EXISTS nemu_interactions (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            total_messages INTEGER DEFAULT 0,
+            times_taught_nemu INTEGER DEFAULT 0,
+            times_helped_by_nemu INTEGER DEFAULT 0,
+            first_interaction TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_interaction TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS nemu_media_cache (
+            url TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers = readers
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._writer_pool: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+
+    @property
+    def available(self) -> bool:
+        return self._writer_pool is not None
+
+    @property
+    def fulltext_ready(self) -> bool:
+        # The FTS5 table is part of the schema
+        return True
+
+    def health(self) -> Dict[str, Any]:
+        return {"connected": self.available, "path": self.path, "readers": self.readers}
+
+    async def open(self) -> None:
+        # WAL lets the reader threads run alongside the single writer thread
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nemu-sqlite-writer")
+        self._reader_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="nemu-sqlite-reader")
+        try:
+            await self._run(self._writer_pool, lambda conn: conn.executescript(self.SCHEMA))
+        except Exception:
+            await self.close()
+            raise
+        logger.info("✅ SQLite knowledge store ready: %s", self.path)
+
+    async def recover(self) -> None:
+        if not self.available:
+            try:
+                await self.open()
+                await load_knowledge_index()
+                await load_media_cache()
+            except Exception as e:
+                logger.error(f"❌ SQLite knowledge store still unavailable: {str(e)}")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DATABASE_TIMEOUTS["query"], isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._connections.append(conn)
+        return conn
+
+    async def _run(self, executor: ThreadPoolExecutor, statement: Callable[[sqlite3.Connection], Any]) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(executor, lambda: statement(self._connection()))
+
+    async def _read(self, statement: Callable[[sqlite3.Connection], Any]) -> Any:
+        return await self._run(self._reader_pool, statement)
+
+    async def _write(self, statement: Callable[[sqlite3.Connection], Any]) -> Any:
+        def transaction(conn: sqlite3.Connection) -> Any:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statement(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+        return await self._run(self._writer_pool, transaction)
+
+    async def write_knowledge(self, chat_id: int, user_id: int, username: str, chat_title: str,
+                              original_query: str, teaching_response: str, trigger_key: str) -> Tuple[int, str]:
+        def upsert(conn: sqlite3.Connection) -> Tuple[int, str]:
+            existing = conn.execute(
+                "SELECT id FROM nemu_global_knowledge WHERE trigger_normalized = ?", (trigger_key,)
+            ).fetchone()
+            if existing:
+                conn.execute("""
+                    UPDATE nemu_global_knowledge
+                    SET response = ?, taught_by_user_id = ?, taught_by_username = ?,
+                        taught_in_chat_id = ?, taught_in_chat_title = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, (teaching_response, user_id, username, chat_id, chat_title, existing[0]))
+                return existing[0], "updated"
+
+            cursor = conn.execute("""
+                INSERT INTO nemu_global_knowledge (trigger_message, response, taught_by_user_id, taught_by_username, taught_in_chat_id, taught_in_chat_title, trigger_normalized)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (original_query, teaching_response, user_id, username, chat_id, chat_title, trigger_key))
+            return cursor.lastrowid, "learned"
+
+        return await self._write(upsert)
+
+    async def lookup(self, query: str, trigger_key: str, include_exact: bool, include_fulltext: bool,
+                     include_partial: bool) -> Optional[Tuple[int, str, str]]:
+        # Every query word must appear, as a single shared word is no evidence of a match; bm25 ranks the rest
+        match_terms = " AND ".join(f'"{term}"' for term in re.findall(r"\w+", trigger_key))
+
+        def cascade(conn: sqlite3.Connection) -> Optional[Tuple[int, str, str]]:
+            if include_exact:
+                row = conn.execute("""
+                    SELECT id, response FROM nemu_global_knowledge WHERE trigger_normalized = ?
+                """, (trigger_key,)).fetchone()
+                if row:
+                    return row[0], row[1], "exact"
+
+            if include_fulltext and match_terms:
+                row = conn.execute("""
+                    SELECT k.id, k.response FROM nemu_knowledge_fts
+                    JOIN nemu_global_knowledge k ON k.id = nemu_knowledge_fts.rowid
+                    WHERE nemu_knowledge_fts MATCH ?
+                    ORDER BY bm25(nemu_knowledge_fts), k.global_usage_count DESC
+                    LIMIT 1
+                """, (match_terms,)).fetchone()
+                if row:
+                    return row[0], row[1], "fulltext"
+
+            if include_partial:
+                row = conn.execute("""
+                    SELECT id, response FROM nemu_global_knowledge
+                    WHERE trigger_normalized != '' AND (instr(trigger_normalized, ?) > 0 OR instr(?, trigger_normalized) > 0)
+                    ORDER BY global_usage_count DESC, updated_at DESC
+                    LIMIT 1
+                """, (trigger_key, trigger_key)).fetchone()
+                if row:
+                    return row[0], row[1], "partial"
+
+            return None
+
+        return await self._read(cascade)
+
+    async def iter_knowledge(self, batch_size: int, updated_since: Optional[str] = None):
+        # Keyset pages, since consecutive reads may land on different threads
+        last_id = 0
+        while True:
+            rows = await self._read(lambda conn: conn.execute("""
+                SELECT id, trigger_message, response, global_usage_count
+                FROM nemu_global_knowledge WHERE id > ? AND (? IS NULL OR updated_at >= ?) ORDER BY id LIMIT ?
+            """, (last_id, updated_since, updated_since, batch_size)).fetchall())
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][0]
+
+    async def watermark(self, overlap: int) -> str:
+        row = await self._read(lambda conn: conn.execute(
+            "SELECT datetime('now', ?)", (f"-{overlap} seconds",)
+        ).fetchone())
+        return row[0]
+
+    async def iter_snapshot_rows(self, batch_size: int):
+        last_id = 0
+        while True:
+            rows = await self._read(lambda conn: conn.execute("""
+                SELECT id, trigger_message, response, taught_by_user_id, taught_by_username,
+                       taught_in_chat_id, taught_in_chat_title, usage_count, global_usage_count,
+                       created_at, updated_at
+                FROM nemu_global_knowledge WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, batch_size)).fetchall())
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][0]
+
+    async def import_snapshot_rows(self, rows: List[tuple]) -> None:
+        # Snapshot ids are not kept, so rows only ever collide on the normalized trigger
+        values = [(*row[1:], normalize_trigger(row[1])) for row in rows]
+        # Upsert values refer to the row as it was before the update, so the newer copy wins
+        await self._write(lambda conn: conn.executemany("""
+            INSERT INTO nemu_global_knowledge (trigger_message, response, taught_by_user_id, taught_by_username,
+                taught_in_chat_id, taught_in_chat_title, usage_count, global_usage_count, created_at, updated_at,
+                trigger_normalized)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP), ?)
+            ON CONFLICT (trigger_normalized) DO UPDATE SET
+            response = CASE WHEN excluded.updated_at >= updated_at THEN excluded.response ELSE response END,
+            usage_count = max(usage_count, excluded.usage_count),
+            global_usage_count = max(global_usage_count, excluded.global_usage_count),
+            updated_at = max(updated_at, excluded.updated_at)
+        """, values))
+
+    async def add_usage(self, counts: Dict[int, int]) -> None:
+        await self._write(lambda conn: conn.executemany("""
+            UPDATE nemu_global_knowledge
+            SET usage_count = usage_count + ?, global_usage_count = global_usage_count + ?
+            WHERE id = ?
+        """, [(amount, amount, knowledge_id) for knowledge_id, amount in counts.items()]))
+
+    async def upsert_interactions(self, deltas: Dict[int, Dict[str, Any]]) -> None:
+        rows = [
+            (user_id, delta["username"], delta["first_name"], delta["total_messages"],
+             delta["times_helped_by_nemu"], delta["times_taught_nemu"])
+            for user_id, delta in deltas.items()
+        ]
+        await self._write(lambda conn: conn.executemany("""
+            INSERT INTO nemu_interactions (user_id, username, first_name, total_messages, times_helped_by_nemu, times_taught_nemu)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+            username = COALESCE(excluded.username, nemu_interactions.username),
+            first_name = COALESCE(excluded.first_name, nemu_interactions.first_name),
+            total_messages = nemu_interactions.total_messages + excluded.total_messages,
+            times_helped_by_nemu = nemu_interactions.times_helped_by_nemu + excluded.times_helped_by_nemu,
+            times_taught_nemu = nemu_interactions.times_taught_nemu + excluded.times_taught_nemu,
+            last_interaction = CURRENT_TIMESTAMP
+        """, rows))
+
+    async def load_media(self) -> Dict[str, str]:
+        return dict(await self._read(lambda conn: conn.execute("SELECT url, file_id FROM nemu_media_cache").fetchall()))
+
+    async def store_media(self, url: str, file_id: str) -> None:
+        await self._write(lambda conn: conn.execute("""
+            INSERT INTO nemu_media_cache (url, file_id) VALUES (?, ?)
+            ON CONFLICT (url) DO UPDATE SET file_id = excluded.file_id, updated_at = CURRENT_TIMESTAMP
+        """, (url, file_id)))
+
+    async def close(self) -> None:
+        pools = [pool for pool in (self._reader_pool, self._writer_pool) if pool is not None]
+        self._reader_pool = self._writer_pool = None
+        for pool in pools:
+            await asyncio.to_thread(pool.shutdown, True)
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+        self._local = threading.local()
+        if pools:
+            logger.info("✅ SQLite knowledge store closed")
+
+# Open the configured knowledge store
+async def init_storage() -> bool:
+    global knowledge_store
+
+    if STORAGE_BACKEND == "sqlite":
+        logger.info("🗄️ Opening embedded SQLite knowledge store...")
+        knowledge_store = SQLiteKnowledgeStore(SQLITE_CONFIG["path"], SQLITE_CONFIG["readers"])
+        try:
+            await knowledge_store.open()
+        except Exception as e:
+            logger.error(f"❌ Error opening SQLite knowledge store: {str(e)}")
+            return False
+        await load_knowledge_index()
+        await load_media_cache()
+        return True
+
+    if DATABASE_URL:
+        knowledge_store = MySQLKnowledgeStore()
+    if not await init_database():
+        return False
+    await init_read_replica()
+    return True
+
+# Load knowledge into the in-memory index
+async def load_knowledge_index():
+    global index_watermark
+
+    if not KNOWLEDGE_INDEX_CONFIG["enabled"]:
+        logger.info("⏭️ In-memory knowledge index disabled")
+        return
 
-                logger.info(f"✅ GLOBAL learning successful: {action}")
-                return action
+    if not database_available():
+        logger.warning("⚠️ Database not available for index load")
+        return
+
+    # After a snapshot warm-up only rows changed since the export are fetched
+    updated_since = index_watermark if knowledge_index.loaded else None
+    logger.info("🧠 Loading knowledge index%s...", f" changes since {updated_since}" if updated_since else "")
+    started = time.monotonic()
+    if not updated_since:
+        knowledge_index.clear()
+
+    try:
+        loaded_at = await knowledge_store.watermark(KNOWLEDGE_INDEX_CONFIG["refresh_overlap"])
+        async for rows in knowledge_store.iter_knowledge(KNOWLEDGE_INDEX_CONFIG["load_batch_size"], updated_since):
+            for knowledge_id, trigger_message, response, usage in rows:
+                if not response:
+                    continue
+                if updated_since:
+                    apply_knowledge_change(normalize_trigger(trigger_message), knowledge_id, response)
+                else:
+                    knowledge_index.add(normalize_trigger(trigger_message), knowledge_id, response, usage or 0)
+
+        knowledge_index.loaded = True
+        index_watermark = loaded_at
+        logger.info(f"✅ Knowledge index loaded: {len(knowledge_index)} triggers in {time.monotonic() - started:.2f}s")
     except Exception as e:
-        logger.error(f"❌ Error learning from reply: {str(e)}")
+        # A snapshot-warmed index is still usable without the delta
+        if not updated_since:
+            knowledge_index.clear()
+        logger.error(f"❌ Error loading knowledge index: {str(e)}")
+
+# Apply a row changed elsewhere, returning whether lookups may now answer differently
+def apply_knowledge_change(trigger_key: str, knowledge_id: int, response: str) -> bool:
+    if knowledge_index.loaded:
+        if knowledge_index.get(trigger_key) == (knowledge_id, response):
+            return False
+        knowledge_index.put(trigger_key, knowledge_id, response)
+    response_cache.invalidate(trigger_key)
+    return True
+
+# Pull rows taught through other replicas since the last watermark
+async def refresh_knowledge_changes() -> int:
+    global index_watermark
+
+    if not database_available():
+        return 0
+
+    refreshed_at = await knowledge_store.watermark(KNOWLEDGE_INDEX_CONFIG["refresh_overlap"])
+    # The first pass only starts the clock when no load has set it
+    if index_watermark is None:
+        index_watermark = refreshed_at
+        return 0
+
+    changed = 0
+    async for rows in knowledge_store.iter_knowledge(KNOWLEDGE_INDEX_CONFIG["load_batch_size"], index_watermark):
+        for knowledge_id, trigger_message, response, _ in rows:
+            if response and apply_knowledge_change(normalize_trigger(trigger_message), knowledge_id, response):
+                changed += 1
+    index_watermark = refreshed_at
+
+    # A new trigger can turn any cached miss into a partial match
+    if changed:
+        response_cache.drop_negative()
+        logger.debug("🔄 Applied %s knowledge changes from other replicas", changed)
+    return changed
+
+# Periodically refresh the index and response cache from the store
+async def knowledge_refresh_loop():
+    while True:
+        await asyncio.sleep(KNOWLEDGE_INDEX_CONFIG["refresh_interval"])
+        try:
+            await refresh_knowledge_changes()
+        except Exception as e:
+            logger.error(f"❌ Error refreshing knowledge changes: {str(e)}")
+
+# Load cached Telegram file_ids for gallery images
+async def load_media_cache():
+    if not database_available():
+        return
+
+    try:
+        cached = await knowledge_store.load_media()
+        media_file_ids.update(cached)
+        logger.info("🖼️ Loaded %s cached photo file_ids", len(cached))
+    except Exception as e:
+        logger.error(f"❌ Error loading media cache: {str(e)}")
+
+# Remember a Telegram file_id for an image URL
+async def store_media_file_id(url: str, file_id: str):
+    media_file_ids[url] = file_id
+    if not database_available():
+        return
+
+    try:
+        await knowledge_store.store_media(url, file_id)
+    except Exception as e:
+        logger.error(f"❌ Error saving media cache entry: {str(e)}")
+
+# Snapshot layout: magic, header, zlib-compressed column chunks, empty chunk, footer, magic
+SNAPSHOT_MAGIC = b"NEMUSNP1"
+SNAPSHOT_COLUMNS = (
+    ("id", "int"),
+    ("trigger_message", "str"),
+    ("response", "str"),
+    ("taught_by_user_id", "int"),
+    ("taught_by_username", "str"),
+    ("taught_in_chat_id", "int"),
+    ("taught_in_chat_title", "str"),
+    ("usage_count", "int"),
+    ("global_usage_count", "int"),
+    ("created_at", "str"),
+    ("updated_at", "str")
+)
+SNAPSHOT_NULL = 0xFFFFFFFF
+
+# Encode a batch of knowledge rows as one compressed columnar chunk
+def encode_snapshot_chunk(rows: List[tuple], level: int) -> bytes:
+    blocks = [struct.pack("<I", len(rows))]
+    for position, (_, column_type) in enumerate(SNAPSHOT_COLUMNS):
+        values = [row[position] for row in rows]
+        if column_type == "int":
+            block = struct.pack(f"<{len(values)}q", *(value or 0 for value in values))
+        else:
+            encoded = [None if value is None else str(value).encode("utf-8") for value in values]
+            lengths = [SNAPSHOT_NULL if value is None else len(value) for value in encoded]
+            block = struct.pack(f"<{len(lengths)}I", *lengths) + b"".join(value for value in encoded if value)
+        blocks.append(struct.pack("<I", len(block)))
+        blocks.append(block)
+    return zlib.compress(b"".join(blocks), level)
+
+# Decode the requested columns of a chunk, skipping the rest
+def decode_snapshot_chunk(chunk: bytes, wanted: Set[str]) -> Dict[str, list]:
+    payload = zlib.decompress(chunk)
+    (count,) = struct.unpack_from("<I", payload)
+    offset = 4
+    columns = {}
+    for name, column_type in SNAPSHOT_COLUMNS:
+        (size,) = struct.unpack_from("<I", payload, offset)
+        offset += 4
+        if name in wanted:
+            if column_type == "int":
+                columns[name] = list(struct.unpack_from(f"<{count}q", payload, offset))
+            else:
+                lengths = struct.unpack_from(f"<{count}I", payload, offset)
+                cursor = offset + 4 * count
+                values = []
+                for length in lengths:
+                    if length == SNAPSHOT_NULL:
+                        values.append(None)
+                        continue
+                    values.append(payload[cursor:cursor + length].decode("utf-8"))
+                    cursor += length
+                columns[name] = values
+        offset += size
+    return columns
+
+# Write a snapshot file from an iterator of row batches, returning its footer
+async def write_snapshot(path: str, batches, watermark: Optional[str] = None) -> Dict[str, Any]:
+    footer = {"rows": 0, "watermark": watermark, "exported_at": datetime.now(timezone.utc).isoformat()}
+    header = json.dumps({"version": 1, "columns": SNAPSHOT_COLUMNS}).encode("utf-8")
+
+    # Written beside the target and renamed, so readers never see a partial file
+    with open(f"{path}.tmp", "wb") as snapshot:
+        snapshot.write(SNAPSHOT_MAGIC + struct.pack("<I", len(header)) + header)
+        async for rows in batches:
+            chunk = await asyncio.to_thread(encode_snapshot_chunk, rows, SNAPSHOT_CONFIG["compression_level"])
+            snapshot.write(struct.pack("<I", len(chunk)) + chunk)
+            footer["rows"] += len(rows)
+        encoded_footer = json.dumps(footer).encode("utf-8")
+        snapshot.write(struct.pack("<I", 0) + encoded_footer + struct.pack("<I", len(encoded_footer)) + SNAPSHOT_MAGIC)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(f"{path}.tmp", path)
+    return footer
+
+# Yield decoded chunks from a snapshot file; the footer comes last
+def read_snapshot(path: str, wanted: Set[str]):
+    with open(path, "rb") as snapshot:
+        if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a knowledge snapshot")
+        (header_size,) = struct.unpack("<I", snapshot.read(4))
+        header = json.loads(snapshot.read(header_size))
+        if [tuple(column) for column in header["columns"]] != list(SNAPSHOT_COLUMNS):
+            raise ValueError(f"{path} has an unsupported column layout")
+
+        while True:
+            (chunk_size,) = struct.unpack("<I", snapshot.read(4))
+            if not chunk_size:
+                break
+            yield decode_snapshot_chunk(snapshot.read(chunk_size), wanted)
+
+        trailer = snapshot.read()
+        (footer_size,) = struct.unpack_from("<I", trailer, len(trailer) - len(SNAPSHOT_MAGIC) - 4)
+        yield json.loads(trailer[:footer_size])
+
+# Read only the index columns of a snapshot, best-first, with its footer
+def read_snapshot_index(path: str) -> Tuple[List[tuple], Dict[str, Any]]:
+    rows = []
+    footer = {}
+    for chunk in read_snapshot(path, {"id", "trigger_message", "response", "global_usage_count"}):
+        if "id" not in chunk:
+            footer = chunk
+            continue
+        rows.extend(zip(chunk["id"], chunk["trigger_message"], chunk["response"], chunk["global_usage_count"]))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows, footer
+
+# Warm the knowledge index from a snapshot before the database is queried
+async def load_knowledge_snapshot() -> None:
+    global index_watermark
+
+    path = SNAPSHOT_CONFIG["path"]
+    if not path or not KNOWLEDGE_INDEX_CONFIG["enabled"]:
+        return
+    if not os.path.exists(path):
+        logger.warning("⚠️ Knowledge snapshot %s not found, loading from the database", path)
+        return
+
+    started = time.monotonic()
+    try:
+        rows, footer = await asyncio.to_thread(read_snapshot_index, path)
+    except (OSError, ValueError, struct.error, zlib.error) as e:
+        logger.error(f"❌ Error reading knowledge snapshot: {str(e)}")
+        return
+
+    knowledge_index.clear()
+    for knowledge_id, trigger_message, response, usage in rows:
+        if response:
+            knowledge_index.add(normalize_trigger(trigger_message), knowledge_id, response, usage)
+    knowledge_index.loaded = True
+    # Without a watermark the database load replaces the warmed index in full
+    index_watermark = footer.get("watermark")
+    logger.info(f"✅ Knowledge index warmed from snapshot: {len(knowledge_index)} triggers in {time.monotonic() - started:.2f}s")
+
+# Export the knowledge table to a snapshot file
+async def export_knowledge_snapshot(path: str) -> None:
+    started = time.monotonic()
+    # Taken before streaming, since rows are read by id and one re-taught mid-export may be older than the newest row seen
+    watermark = await knowledge_store.watermark(KNOWLEDGE_INDEX_CONFIG["refresh_overlap"])
+    footer = await write_snapshot(path, knowledge_store.iter_snapshot_rows(SNAPSHOT_CONFIG["chunk_rows"]), watermark)
+    logger.info(f"✅ Exported {footer['rows']} knowledge rows to {path} in {time.monotonic() - started:.2f}s")
+
+# Import a snapshot file into the knowledge table in batches
+async def import_knowledge_snapshot(path: str) -> None:
+    started = time.monotonic()
+    imported = 0
+    for chunk in read_snapshot(path, {name for name, _ in SNAPSHOT_COLUMNS}):
+        if "id" not in chunk:
+            break
+        rows = list(zip(*(chunk[name] for name, _ in SNAPSHOT_COLUMNS)))
+        await knowledge_store.import_snapshot_rows(rows)
+        imported += len(rows)
+        logger.debug("📥 Imported %s knowledge rows", imported)
+    logger.info(f"✅ Imported {imported} knowledge rows from {path} in {time.monotonic() - started:.2f}s")
+
+# Run a maintenance command against the configured store instead of the bot
+async def run_maintenance_command(command: str, path: Optional[str]) -> int:
+    # The in-process index is not needed to move data in or out
+    KNOWLEDGE_INDEX_CONFIG["enabled"] = False
+
+    try:
+        if not await init_storage():
+            logger.error("💀 Knowledge store unavailable, %s aborted", command)
+            return 1
+        if command == "export-snapshot":
+            await export_knowledge_snapshot(path)
+        elif command == "import-snapshot":
+            await import_knowledge_snapshot(path)
+        elif isinstance(knowledge_store, MySQLKnowledgeStore):
+            await add_trigger_fulltext_index()
+        else:
+            logger.info("⏭️ SQLite keeps its fulltext table in the schema, nothing to migrate")
+        return 0
+    finally:
+        for task in list(background_tasks):
+            task.cancel()
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        if knowledge_store is not None:
+            await knowledge_store.close()
+        await bot.session.close()
+
+# Connect the optional read replica pool
+async def init_read_replica():
+    global db_read_pool
+
+    if not DATABASE_READ_URL or not db_pool:
+        return False
+
+    logger.info("🗄️ Connecting read replica...")
+    if not validate_database_url(DATABASE_READ_URL):
+        logger.error("❌ Invalid DATABASE_READ_URL, reading from primary")
+        return False
+
+    try:
+        db_read_pool = await create_db_pool(DATABASE_READ_URL)
+    except Exception as e:
+        logger.error(f"❌ Read replica unavailable, reading from primary: {str(e)}")
+        return False
+
+    await check_replica_health()
+    start_background_task(replica_health_loop(), "replica-health")
+    logger.info("✅ Read replica connected (healthy=%s, lag=%s)", replica_healthy, replica_lag)
+    return True
+
+# Measure replica lag against a heartbeat row written on the primary
+async def check_replica_health():
+    global replica_healthy, replica_lag
+
+    try:
+        async with db_acquire() as conn:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, """
+                    INSERT INTO nemu_replica_heartbeat (id, beat) VALUES (1, UTC_TIMESTAMP(6)) AS new_data
+                    ON DUPLICATE KEY UPDATE beat = new_data.beat
+                """)
+
+        conn = await acquire_connection(db_read_pool)
+        try:
+            async with conn.cursor() as cursor:
+                await db_execute(cursor, """
+                    SELECT TIMESTAMPDIFF(MICROSECOND, beat, UTC_TIMESTAMP(6)) / 1000000
+                    FROM nemu_replica_heartbeat WHERE id = 1
+                """)
+                result = await cursor.fetchone()
+        finally:
+            db_read_pool.release(conn)
+    except Exception as e:
+        replica_lag = None
+        mark_replica_unhealthy(str(e) or type(e).__name__)
+        return
+
+    # No heartbeat yet means the replica has not caught up with the table
+    replica_lag = max(float(result[0]), 0.0) if result and result[0] is not None else None
+    if replica_lag is None or replica_lag > REPLICA_CONFIG["max_lag"]:
+        mark_replica_unhealthy(f"lag {replica_lag}s exceeds {REPLICA_CONFIG['max_lag']}s")
+    elif not replica_healthy:
+        replica_healthy = True
+        logger.info("✅ Read replica healthy (lag %.3fs), routing lookups to it", replica_lag)
+
+# Periodically re-check the replica
+async def replica_health_loop():
+    while True:
+        await asyncio.sleep(REPLICA_CONFIG["check_interval"])
+        await check_replica_health()
+
+# Write taught knowledge to the store, returning (knowledge_id, action)
+async def write_knowledge(chat_id: int, user_id: int, username: str, chat_title: str, original_query: str, teaching_response: str) -> Tuple[int, str]:
+    trigger_key = normalize_trigger(original_query)
+    knowledge_id, action = await knowledge_store.write_knowledge(
+        chat_id, user_id, username, chat_title, original_query, teaching_response, trigger_key
+    )
+
+    recent_writes[trigger_key] = True
+    if knowledge_index.loaded:
+        knowledge_index.put(trigger_key, knowledge_id, teaching_response)
+    response_cache.invalidate(trigger_key)
+    return knowledge_id, action
+
+# Learn from user reply to bot
+@timed(learn_seconds)
+async def learn_from_reply(chat_id: int, user_id: int, username: str, chat_title: str, original_query: str, teaching_response: str):
+    logger.info("🌍 GLOBAL learning attempt - User: %s (%s)", username, user_id)
+
+    # Without a store a journaled teach could never be replayed
+    if knowledge_store is None:
+        logger.warning("⚠️ Database not available for learning")
+        return "failed"
+
+    if database_available():
+        try:
+            knowledge_id, action = await write_knowledge(chat_id, user_id, username, chat_title, original_query, teaching_response)
+            logger.debug(f"📊 Updating user interaction stats")
+            record_user_interaction(user_id, username=username, taught=1)
+            logger.info("✅ GLOBAL learning successful: %s", action)
+            return action
+        except (DatabaseUnavailable, *DB_CONNECTION_ERRORS) as e:
+            logger.warning(f"⚠️ Database unavailable while learning, journaling instead: {str(e)}")
+        except Exception as e:
+            logger.error(f"❌ Error learning from reply: {str(e)}")
+            return "failed"
+
+    # Degraded mode: keep the teach locally and serve it from memory until replay
+    try:
+        await write_journal.append([{
+            "kind": "teach",
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "username": username,
+            "chat_title": chat_title,
+            "query": original_query,
+            "response": teaching_response,
+            "at": time.time()
+        }])
+    except OSError as e:
+        logger.error(f"❌ Error journaling taught knowledge: {str(e)}")
         return "failed"
 
+    trigger_key = normalize_trigger(original_query)
+    knowledge_index.put(trigger_key, 0, teaching_response)
+    response_cache.invalidate(trigger_key)
+    record_user_interaction(user_id, username=username, taught=1)
+    logger.info("📼 GLOBAL learning journaled until the database recovers")
+    return "learned"
+
+# Build cascaded lookup SQL once per combination of tiers
+@functools.lru_cache(maxsize=None)
+def cascade_lookup_sql(include_exact: bool, hashed: bool, include_fulltext: bool, include_partial: bool) -> str:
+    branches = []
+    # Server-side deadline so abandoned statements stop running too
+    hint = f"/*+ MAX_EXECUTION_TIME({int(DATABASE_TIMEOUTS['query'] * 1000)}) */"
+
+    if include_exact:
+        where_clause = "trigger_hash = %s AND trigger_normalized = %s" if hashed else "LOWER(trigger_message) = LOWER(%s)"
+        branches.append(f"""
+            (SELECT response, id, 1 AS tier FROM nemu_global_knowledge
+            WHERE {where_clause}
+            ORDER BY global_usage_count DESC, updated_at DESC
+            LIMIT 1)
+        """)
+
+    if include_fulltext:
+        branches.append("""
+            (SELECT response, id, 2 AS tier FROM nemu_global_knowledge
+            WHERE MATCH(trigger_message) AGAINST(%s IN NATURAL LANGUAGE MODE) > 0.3
+            ORDER BY MATCH(trigger_message) AGAINST(%s IN NATURAL LANGUAGE MODE) DESC, global_usage_count DESC
+            LIMIT 1)
+        """)
+
+    if include_partial:
+        branches.append("""
+            (SELECT response, id, 3 AS tier FROM nemu_global_knowledge
+            WHERE LOWER(trigger_message) LIKE CONCAT('%%', LOWER(%s), '%%')
+            OR LOWER(%s) LIKE CONCAT('%%', LOWER(trigger_message), '%%')
+            ORDER BY global_usage_count DESC, updated_at DESC
+            LIMIT 1)
+        """)
+
+    sql = " UNION ALL ".join(branches) + " ORDER BY tier LIMIT 1"
+    return sql.replace("SELECT", f"SELECT {hint}", 1)
+
+# Build a single-round-trip cascaded lookup over the requested tiers
+def build_cascade_lookup(query: str, include_exact: bool, include_fulltext: bool, include_partial: bool) -> Tuple[str, tuple]:
+    args = []
+
+    if include_exact:
+        args.extend(exact_trigger_clause(query)[1])
+    if include_fulltext:
+        args.extend((query, query))
+    if include_partial:
+        args.extend((query, query))
+
+    sql = cascade_lookup_sql(include_exact, trigger_backfill_done, include_fulltext, include_partial)
+    return sql, tuple(args)
+
+# Look up the best knowledge match as (id, response, tier)
+async def lookup_knowledge(query: str) -> Optional[Tuple[int, str, str]]:
+    trigger_key = normalize_trigger(query)
+    # Without a database, whatever the index holds is the best answer available
+    use_index = knowledge_index.loaded or not database_available()
+
+    # Exact matches are served from memory without touching the database
+    if use_index:
+        logger.debug("🎯 Attempting exact match in knowledge index")
+        indexed = knowledge_index.get(trigger_key)
+        if indexed:
+            return indexed[0], indexed[1], "exact"
+
+    # Resolve the remaining database tiers in one round trip
+    include_exact = not knowledge_index.loaded
+    include_fulltext = len(query.split()) >= 2 and knowledge_store is not None and knowledge_store.fulltext_ready
+    include_partial = not knowledge_index.loaded
+    needs_database = include_exact or include_fulltext or include_partial
+
+    # Tiers the database could not answer make a miss inconclusive
+    failure = None
+    if needs_database and knowledge_store is not None and not database_available():
+        failure = DatabaseUnavailable("knowledge store unavailable")
+    elif needs_database and database_available():
+        logger.debug("🔎 Running cascaded knowledge lookup")
+        try:
+            result = await knowledge_store.lookup(query, trigger_key, include_exact, include_fulltext, include_partial)
+        except (DatabaseUnavailable, *DB_CONNECTION_ERRORS) as e:
+            if not len(knowledge_index):
+                raise
+            logger.debug("🧠 Database lookup failed, falling back to knowledge index")
+            use_index = True
+            failure = e
+            result = None
+
+        if result:
+            return result
+
+    if use_index:
+        logger.debug("🔍 Trying GLOBAL partial matching in knowledge index")
+        indexed = knowledge_index.find_partial(trigger_key)
+        if indexed:
+            return indexed[0], indexed[1], "partial"
+
+    if failure is not None:
+        raise failure
+    return None
+
+# Count and time a lookup by the tier that answered it
+def record_lookup(tier: str, started: float) -> None:
+    lookup_tier_counts[tier] += 1
+    lookup_seconds.observe(time.perf_counter() - started, tier=tier)
+
 # Find response in knowledge base
 async def find_nemu_response(query: str) -> Optional[str]:
-    global db_pool
-
     logger.debug(f"🌍 Searching GLOBAL knowledge")
 
-    if not db_pool or not query.strip():
+    if not query.strip() or (not database_available() and not len(knowledge_index)):
         logger.warning("⚠️ Database unavailable or empty query")
         return None
 
+    started = time.perf_counter()
+    cache_key = normalize_trigger(query)
+    cached = response_cache.get(cache_key)
+    if cached is not CACHE_MISS:
+        record_lookup("cache", started)
+        if cached is None:
+            logger.debug("❌ No matches found in knowledge (cached)")
+            return None
+        logger.debug("⚡ GLOBAL match served from response cache")
+        if cached[0] and knowledge_store is not None:
+            usage_counters.add(cached[0])
+        return cached[1]
+
     try:
-        async with db_pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                logger.debug("🎯 Attempting exact match search")
-                await cursor.execute("""
-                    SELECT response, id FROM nemu_global_knowledge 
-                    WHERE LOWER(trigger_message) = LOWER(%s)
-                    ORDER BY global_usage_count DESC, updated_at DESC
-                    LIMIT 1
-                """, (query,))
+        match = await lookup_knowledge(query)
+    except (DatabaseUnavailable, *DB_CONNECTION_ERRORS) as e:
+        # The database may hold an answer, so this is neither a miss nor cached
+        record_lookup("degraded", started)
+        logger.debug(f"⚠️ Knowledge lookup degraded: {str(e)}")
+        return None
+    except Exception as e:
+        record_lookup("error", started)
+        logger.error(f"❌ Error finding response: {str(e)}")
+        return None
 
-                result = await cursor.fetchone()
+    if not match:
+        record_lookup("miss", started)
+        logger.debug("❌ No matches found in knowledge")
+        response_cache.put_negative(cache_key)
+        return None
 
-                if result and result[0]:
-                    logger.info(f"✅ GLOBAL exact match found")
-                    await cursor.execute("""
-                        UPDATE nemu_global_knowledge 
-                        SET usage_count = usage_count + 1, global_usage_count = global_usage_count + 1 
-                        WHERE id = %s
-                    """, (result[1],))
-                    return result[0]
-
-                # Try fulltext search if available
-                logger.debug("🔎 Exact match not found, trying fulltext")
-                if len(query.split()) >= 2:
-                    await cursor.execute("""
-                        SELECT response, id,
-                        MATCH(trigger_message) AGAINST(%s IN NATURAL LANGUAGE MODE) as relevance
-                        FROM nemu_global_knowledge 
-                        WHERE MATCH(trigger_message) AGAINST(%s IN NATURAL LANGUAGE MODE) > 0.3
-                        ORDER BY relevance DESC, global_usage_count DESC
-                        LIMIT 1
-                    """, (query, query))
+    knowledge_id, response, tier = match
+    record_lookup(tier, started)
+    logger.info("✅ GLOBAL %s match found", tier)
+    response_cache.put(cache_key, (knowledge_id, response))
+    # Journaled teaches have no database id until they are replayed
+    if knowledge_id and knowledge_store is not None:
+        usage_counters.add(knowledge_id)
+    return response
+
+# Flush buffered usage counters in one statement
+async def flush_usage_counters() -> int:
+    if not usage_counters.pending:
+        return 0
+    if not database_available():
+        await spool_pending_stats()
+        return 0
+
+    counts = usage_counters.drain()
 
-                    result = await cursor.fetchone()
+    try:
+        await knowledge_store.add_usage(counts)
+        flushed = sum(counts.values())
+        logger.debug("💾 Flushed %s usage increments for %s triggers", flushed, len(counts))
+        return flushed
+    except asyncio.CancelledError:
+        usage_counters.restore(counts)
+        raise
+    except Exception as e:
+        usage_counters.restore(counts)
+        logger.error(f"❌ Error flushing usage counters: {str(e)}")
+        return 0
+
+# Move buffered stat deltas to the journal while the database is unavailable
+async def spool_pending_stats() -> None:
+    # Without a configured store there is nothing to replay into, so drop what was buffered
+    if knowledge_store is None:
+        usage_counters.drain()
+        interaction_stats.drain()
+        return
 
-                    if result and result[0]:
-                        logger.info(f"✅ GLOBAL fulltext match found")
-                        await cursor.execute("""
-                            UPDATE nemu_global_knowledge 
-                            SET usage_count = usage_count + 1, global_usage_count = global_usage_count + 1 
-                            WHERE id = %s
-                        """, (result[1],))
-                        return result[0]
-
-                # Try partial matching as fallback
-                logger.debug("🔍 Trying GLOBAL partial matching")
-                await cursor.execute("""
-                    SELECT response, id FROM nemu_global_knowledge 
-                    WHERE LOWER(trigger_message) LIKE CONCAT('%%', LOWER(%s), '%%') 
-                    OR LOWER(%s) LIKE CONCAT('%%', LOWER(trigger_message), '%%')
-                    ORDER BY global_usage_count DESC, updated_at DESC
-                    LIMIT 1
-                """, (query, query))
+    entries = []
+    if usage_counters.pending:
+        entries.append({"kind": "usage", "counts": usage_counters.drain()})
+    if interaction_stats.pending:
+        entries.append({"kind": "interactions", "deltas": interaction_stats.drain()})
+    if not entries:
+        return
 
-                result = await cursor.fetchone()
+    try:
+        await write_journal.append(entries)
+        logger.debug("📼 Journaled %s stat batches while the database is unavailable", len(entries))
+    except OSError as e:
+        for entry in entries:
+            restore_journaled_stats(entry)
+        logger.error(f"❌ Error journaling stats: {str(e)}")
+
+# Put journaled stat deltas back into the write-behind buffers
+def restore_journaled_stats(entry: Dict[str, Any]) -> None:
+    if entry["kind"] == "usage":
+        usage_counters.restore({int(knowledge_id): amount for knowledge_id, amount in entry["counts"].items()})
+    elif entry["kind"] == "interactions":
+        interaction_stats.restore({int(user_id): delta for user_id, delta in entry["deltas"].items()})
+
+# Apply journaled writes in order once the database is reachable again
+async def replay_journal() -> None:
+    entries = await write_journal.take()
+    if not entries:
+        return
 
-                if result and result[0]:
-                    logger.info(f"✅ GLOBAL partial match found")
-                    await cursor.execute("""
-                        UPDATE nemu_global_knowledge 
-                        SET usage_count = usage_count + 1, global_usage_count = global_usage_count + 1 
-                        WHERE id = %s
-                    """, (result[1],))
-                    return result[0]
-                    
-                logger.debug("❌ No matches found in knowledge")
+    logger.info("📼 Replaying %s journaled writes", len(entries))
+    for position, entry in enumerate(entries):
+        try:
+            if entry["kind"] == "teach":
+                await write_knowledge(entry["chat_id"], entry["user_id"], entry["username"],
+                                      entry["chat_title"], entry["query"], entry["response"])
+            else:
+                restore_journaled_stats(entry)
+        except Exception as e:
+            await write_journal.settle(entries[position:], position)
+            logger.error(f"❌ Journal replay stopped at entry {position + 1}/{len(entries)}: {str(e)}")
+            return
+
+    await write_journal.settle([], len(entries))
+    await flush_usage_counters()
+    await flush_interaction_stats()
+    logger.info("✅ Journal replayed: %s writes", len(entries))
+
+# Serve journaled teaches from memory when starting without a database
+async def seed_index_from_journal() -> None:
+    try:
+        entries = await write_journal.peek()
+    except OSError as e:
+        logger.error(f"❌ Error reading journal: {str(e)}")
+        return
+
+    teaches = [entry for entry in entries if entry.get("kind") == "teach"]
+    for entry in teaches:
+        knowledge_index.put(normalize_trigger(entry["query"]), 0, entry["response"])
+    if teaches:
+        logger.info("🧠 Seeded knowledge index with %s journaled teaches", len(teaches))
+
+# Check a tripped database circuit with a single ping
+async def probe_database() -> None:
+    try:
+        async with db_acquire() as conn:
+            await conn.ping(reconnect=False)
     except Exception as e:
-        logger.error(f"❌ Error finding response: {str(e)}")
+        logger.debug("🔌 Database probe failed: %s", e)
 
-    return None
+# Reconnect to the database and replay the journal once it is reachable
+async def database_recovery_loop():
+    while True:
+        await asyncio.sleep(JOURNAL_CONFIG["recovery_interval"])
+
+        # One failed pass must not end recovery for the rest of the process
+        try:
+            await knowledge_store.recover()
+
+            if database_available() and write_journal.has_entries:
+                await replay_journal()
+        except Exception as e:
+            logger.error(f"❌ Error during database recovery: {str(e)}")
+
+# Periodically flush write-behind buffers
+async def write_behind_loop():
+    while True:
+        await asyncio.sleep(WRITE_BEHIND_CONFIG["flush_interval"])
+        await flush_usage_counters()
+        await flush_interaction_stats()
 
 # Update user interaction statistics
 async def update_user_interaction(user_id: int, username: str = None, first_name: str = None, helped_by_nemu: bool = False):
-    global db_pool
-
     logger.debug(f"📊 Updating interaction stats")
+    record_user_interaction(user_id, username, first_name, messages=1, helped=1 if helped_by_nemu else 0)
 
-    if not db_pool:
-        logger.warning("⚠️ Database unavailable for interaction update")
+# Buffer an interaction delta and flush early when the buffer is large
+def record_user_interaction(user_id: int, username: str = None, first_name: str = None,
+                            messages: int = 0, helped: int = 0, taught: int = 0) -> None:
+    global interaction_flush_task
+
+    # Stats are only kept for a store that can persist them
+    if knowledge_store is None:
         return
 
-    try:
-        async with db_pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                helped_count = 1 if helped_by_nemu else 0
+    interaction_stats.record(user_id, username, first_name, messages, helped, taught)
 
-                await cursor.execute("""
-                    INSERT INTO nemu_interactions (user_id, username, first_name, total_messages, times_helped_by_nemu)
-                    VALUES (%s, %s, %s, 1, %s) AS new_data
-                    ON DUPLICATE KEY UPDATE
-                    username = new_data.username,
-                    first_name = new_data.first_name,
-                    total_messages = nemu_interactions.total_messages + 1,
-                    times_helped_by_nemu = nemu_interactions.times_helped_by_nemu + new_data.times_helped_by_nemu,
-                    last_interaction = CURRENT_TIMESTAMP
-                """, (user_id, username, first_name, helped_count))
-                
-                logger.debug(f"✅ User interaction updated")
+    if interaction_stats.pending >= WRITE_BEHIND_CONFIG["max_pending_users"]:
+        if interaction_flush_task is None or interaction_flush_task.done():
+            interaction_flush_task = start_background_task(flush_interaction_stats(), "interaction-flush")
+
+# Flush buffered interaction deltas as one multi-row upsert
+async def flush_interaction_stats() -> int:
+    if not interaction_stats.pending:
+        return 0
+    if not database_available():
+        await spool_pending_stats()
+        return 0
+
+    deltas = interaction_stats.drain()
+
+    # Handlers only touch the buffer, so the upsert is the latency worth measuring
+    started = time.perf_counter()
+    try:
+        await knowledge_store.upsert_interactions(deltas)
+        logger.debug("✅ Flushed interaction stats for %s users", len(deltas))
+        return len(deltas)
+    except asyncio.CancelledError:
+        interaction_stats.restore(deltas)
+        raise
     except Exception as e:
+        interaction_stats.restore(deltas)
         logger.error(f"❌ Error updating user interaction: {str(e)}")
+        return 0
+    finally:
+        interaction_update_seconds.observe(time.perf_counter() - started)
 
 # Setup bot commands menu
 async def setup_commands():
@@ -691,19 +3370,104 @@ async def setup_commands():
     except Exception as e:
         logger.error(f"❌ Failed to setup commands: {str(e)}")
 
-# Start HTTP server thread
-try:
-    threading.Thread(target=start_dummy_server, daemon=True).start()
-    logger.info("🧵 HTTP server thread started")
-except Exception as e:
-    logger.error(f"❌ Failed to start HTTP thread: {e}")
-
 # Log bot initialization status
 logger.info(f"🚀 Bot initialization with TOKEN: {'✅ Set' if BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE' else '❌ Not Set'}")
 logger.info(f"🗄️ Database URL: {'✅ Configured' if DATABASE_URL else '❌ Not Configured'}")
 logger.info(f"📸 Loaded {len(IMAGES)} images")
 logger.info("📝 Help messages and data initialized")
 
+# Count handlers currently processing updates
+@dp.update.outer_middleware()
+async def track_inflight_handlers(handler, event, data):
+    global inflight_handlers
+
+    inflight_handlers += 1
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_handlers -= 1
+
+# Build a single-button help toggle keyboard
+def build_help_markup(button_key: str) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text=KEYBOARD_BUTTONS[button_key]["text"], callback_data=KEYBOARD_BUTTONS[button_key]["callback"]))
+    return builder.as_markup()
+
+# Build /start keyboard for the bot's username
+def build_start_markup(bot_username: str) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text=KEYBOARD_BUTTONS["updates"]["text"], url=KEYBOARD_BUTTONS["updates"]["url"]),
+        InlineKeyboardButton(text=KEYBOARD_BUTTONS["support"]["text"], url=KEYBOARD_BUTTONS["support"]["url"])
+    )
+    group_add_url = f"https://t.me/{bot_username}?startgroup=true"
+    builder.row(
+        InlineKeyboardButton(text=KEYBOARD_BUTTONS["add_to_group"]["text"], url=group_add_url)
+    )
+    return builder.as_markup()
+
+# Prebuilt static keyboards
+HELP_EXPAND_MARKUP = build_help_markup("help_expand")
+HELP_MINIMIZE_MARKUP = build_help_markup("help_minimize")
+
+# Cached bot identity and the /start keyboard derived from it
+bot_identity = None
+start_markup = None
+
+# Fetch bot identity and rebuild the /start keyboard
+async def refresh_bot_identity() -> bool:
+    global bot_identity, start_markup
+
+    try:
+        identity = await bot.get_me()
+    except Exception as e:
+        logger.error(f"❌ Failed to fetch bot identity: {str(e)}")
+        return False
+
+    bot_identity = identity
+    start_markup = build_start_markup(identity.username)
+    logger.info("🪪 Bot identity cached: @%s", identity.username)
+    return True
+
+# Refresh bot identity occasionally
+async def bot_identity_refresh_loop():
+    while True:
+        await asyncio.sleep(BOT_IDENTITY_CONFIG["refresh_interval"])
+        await refresh_bot_identity()
+
+# Send a gallery photo, reusing Telegram's file_id after the first upload
+async def answer_gallery_photo(message: Message, url: str, **kwargs) -> Message:
+    file_id = media_file_ids.get(url)
+    if file_id:
+        try:
+            return await message.answer_photo(photo=file_id, **kwargs)
+        except TelegramBadRequest as e:
+            logger.warning(f"⚠️ Cached photo file_id rejected, re-sending by URL: {str(e)}")
+            media_file_ids.pop(url, None)
+
+    sent = await message.answer_photo(photo=url, **kwargs)
+    if sent.photo:
+        start_background_task(store_media_file_id(url, sent.photo[-1].file_id), "media-cache-store")
+    return sent
+
+# Upload uncached gallery images to a warmup chat to collect their file_ids
+async def warm_media_cache():
+    chat_id = int(MEDIA_WARMUP_CHAT_ID)
+    pending = [url for url in IMAGES if url not in media_file_ids]
+    logger.info("🔥 Warming photo cache for %s images", len(pending))
+
+    for url in pending:
+        try:
+            sent = await bot.send_photo(chat_id=chat_id, photo=url, disable_notification=True)
+            if sent.photo:
+                await store_media_file_id(url, sent.photo[-1].file_id)
+            await bot.delete_message(chat_id=chat_id, message_id=sent.message_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to warm photo {url}: {str(e)}")
+        await asyncio.sleep(MEDIA_CACHE_CONFIG["warmup_pause"])
+
+    logger.info("✅ Photo cache warmup finished")
+
 # Handle /start command
 @dp.message(CommandStart())
 async def start_command(message: Message):
@@ -716,31 +3480,22 @@ async def start_command(message: Message):
         # Update user interaction stats
         await update_user_interaction(user.id, user.username, user.first_name)
 
-        # Build inline keyboard
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text=KEYBOARD_BUTTONS["updates"]["text"], url=KEYBOARD_BUTTONS["updates"]["url"]),
-            InlineKeyboardButton(text=KEYBOARD_BUTTONS["support"]["text"], url=KEYBOARD_BUTTONS["support"]["url"])
-        )
-
-        # Add group button dynamically
-        bot_info = await bot.get_me()
-        group_add_url = f"https://t.me/{bot_info.username}?startgroup=true"
-        builder.row(
-            InlineKeyboardButton(text=KEYBOARD_BUTTONS["add_to_group"]["text"], url=group_add_url)
-        )
+        # Fetch bot identity only if startup could not
+        if start_markup is None:
+            await refresh_bot_identity()
 
         # Select random image
         random_image = random.choice(IMAGES)
-        logger.debug(f"🎲 Selected random image: {random_image}")
+        logger.debug("🎲 Selected random image: %s", random_image)
 
         # Format welcome message
         welcome_text = START_MESSAGE.format(first_name=user.first_name)
 
-        await message.answer_photo(
-            photo=random_image,
+        await answer_gallery_photo(
+            message,
+            random_image,
             caption=welcome_text,
-            reply_markup=builder.as_markup(),
+            reply_markup=start_markup,
             parse_mode=ParseMode.HTML
         )
         
@@ -748,7 +3503,7 @@ async def start_command(message: Message):
         
     except Exception as e:
         logger.error(f"❌ Error in start command: {str(e)}")
-        log_with_user_info("ERROR", f"❌ /start command failed: {str(e)}", user_info)
+        log_with_user_info("ERROR", "❌ /start command failed: %s", user_info, e)
 
 # Handle /help command
 @dp.message(Command("help"))
@@ -757,13 +3512,9 @@ async def help_command(message: Message):
     log_with_user_info("INFO", "❓ /help command triggered", user_info)
     
     try:
-        # Build help keyboard
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(text=KEYBOARD_BUTTONS["help_expand"]["text"], callback_data=KEYBOARD_BUTTONS["help_expand"]["callback"]))
-
         await message.answer(
             HELP_SHORT_MESSAGE,
-            reply_markup=builder.as_markup(),
+            reply_markup=HELP_EXPAND_MARKUP,
             parse_mode=ParseMode.HTML
         )
         
@@ -771,7 +3522,7 @@ async def help_command(message: Message):
         
     except Exception as e:
         logger.error(f"❌ Error in help command: {str(e)}")
-        log_with_user_info("ERROR", f"❌ /help command failed: {str(e)}", user_info)
+        log_with_user_info("ERROR", "❌ /help command failed: %s", user_info, e)
 
 # Handle help expand callback
 @dp.callback_query(F.data == "help_expand")
@@ -780,13 +3531,9 @@ async def expand_help(callback: CallbackQuery):
     log_with_user_info("INFO", "📖 Help expand callback triggered", user_info)
     
     try:
-        # Build minimize keyboard
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(text=KEYBOARD_BUTTONS["help_minimize"]["text"], callback_data=KEYBOARD_BUTTONS["help_minimize"]["callback"]))
-
         await callback.message.edit_text(
             HELP_LONG_MESSAGE,
-            reply_markup=builder.as_markup(),
+            reply_markup=HELP_MINIMIZE_MARKUP,
             parse_mode=ParseMode.HTML
         )
         await callback.answer()
@@ -795,7 +3542,7 @@ async def expand_help(callback: CallbackQuery):
         
     except Exception as e:
         logger.error(f"❌ Error expanding help: {str(e)}")
-        log_with_user_info("ERROR", f"❌ Help expand failed: {str(e)}", user_info)
+        log_with_user_info("ERROR", "❌ Help expand failed: %s", user_info, e)
 
 # Handle help minimize callback
 @dp.callback_query(F.data == "help_minimize")
@@ -804,13 +3551,9 @@ async def minimize_help(callback: CallbackQuery):
     log_with_user_info("INFO", "📕 Help minimize callback triggered", user_info)
     
     try:
-        # Build expand keyboard
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(text=KEYBOARD_BUTTONS["help_expand"]["text"], callback_data=KEYBOARD_BUTTONS["help_expand"]["callback"]))
-
         await callback.message.edit_text(
             HELP_SHORT_MESSAGE,
-            reply_markup=builder.as_markup(),
+            reply_markup=HELP_EXPAND_MARKUP,
             parse_mode=ParseMode.HTML
         )
         await callback.answer()
@@ -819,7 +3562,7 @@ async def minimize_help(callback: CallbackQuery):
         
     except Exception as e:
         logger.error(f"❌ Error minimizing help: {str(e)}")
-        log_with_user_info("ERROR", f"❌ Help minimize failed: {str(e)}", user_info)
+        log_with_user_info("ERROR", "❌ Help minimize failed: %s", user_info, e)
 
 # Handle /ping command
 @dp.message(Command("ping"))
@@ -850,11 +3593,117 @@ async def ping_command(message: Message):
             disable_web_page_preview=True
         )
         
-        log_with_user_info("INFO", f"✅ /ping completed: {ping_time}ms", user_info)
+        log_with_user_info("INFO", "✅ /ping completed: %sms", user_info, ping_time)
         
     except Exception as e:
         logger.error(f"❌ Error in ping command: {str(e)}")
-        log_with_user_info("ERROR", f"❌ /ping command failed: {str(e)}", user_info)
+        log_with_user_info("ERROR", "❌ /ping command failed: %s", user_info, e)
+
+# Compute typing delay for a reply
+def typing_delay(text: str) -> float:
+    if not REPLY_CONFIG["adaptive_delay"]:
+        return REPLY_CONFIG["typing_delay"]
+    delay = len(text) / REPLY_CONFIG["chars_per_second"]
+    return max(REPLY_CONFIG["min_delay"], min(REPLY_CONFIG["max_delay"], delay))
+
+# Send through the rate limiter, backing off on RetryAfter
+async def send_rate_limited(chat_id: int, is_group: bool, send: Callable[[], Awaitable[Any]]) -> Any:
+    attempts = RATE_LIMIT_CONFIG["max_send_attempts"]
+    for attempt in range(1, attempts + 1):
+        await rate_limiter.acquire(chat_id, is_group)
+        try:
+            return await send()
+        except TelegramRetryAfter as e:
+            rate_limiter.block(chat_id, e.retry_after)
+            logger.warning(f"⏳ Flood limit in chat {chat_id}, retrying after {e.retry_after}s (attempt {attempt}/{attempts})")
+            if attempt == attempts:
+                raise
+
+# Show typing indicator if the chat has budget to spare, otherwise skip it
+async def send_typing(chat_id: int, is_group: bool) -> None:
+    if not rate_limiter.try_acquire(chat_id, is_group, RATE_LIMIT_CONFIG["typing_reserve"]):
+        logger.debug("⏭️ Typing action dropped by rate limiter")
+        return
+
+    try:
+        await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    except TelegramRetryAfter as e:
+        rate_limiter.block(chat_id, e.retry_after)
+    except Exception as e:
+        logger.debug("⚠️ Typing action failed: %s", e)
+
+# Send a Nemu reply and track it for follow-ups
+async def send_nemu_reply(message: Message, text: str, learning_query: Optional[str] = None):
+    response_msg = await send_rate_limited(
+        message.chat.id,
+        message.chat.type != ChatType.PRIVATE,
+        lambda: message.reply(text, parse_mode=ParseMode.HTML)
+    )
+    message_key = pack_message_key(response_msg.chat.id, response_msg.message_id)
+    await bot_messages.set(message_key, 1)
+
+    if learning_query is None:
+        return
+
+    # Store learning request, evicting the oldest past capacity
+    await learning_requests.set(message_key, learning_query)
+    logger.debug(f"📝 Stored GLOBAL learning request")
+
+# Look up a query and schedule Nemu's reply, returning the reply task
+async def answer_nemu_query(message: Message, query: str, user_info: Dict[str, any]) -> Optional[asyncio.Task]:
+    user = message.from_user
+    chat_id = message.chat.id
+    is_group = message.chat.type != ChatType.PRIVATE
+
+    # Search for existing response
+    logger.debug(f"🌍 Searching GLOBAL knowledge base")
+    response = await find_nemu_response(query)
+
+    if response:
+        # Found response in knowledge base
+        log_with_user_info("INFO", "🧠 GLOBAL knowledge found", user_info)
+        await update_user_interaction(user.id, user.username, user.first_name, helped_by_nemu=True)
+
+        # Add personality prefix randomly
+        if random.random() < LEARNING_CONFIG["personality_chance"]:
+            personality_prefix = random.choice(PERSONALITY_PREFIXES)
+            response = personality_prefix + response
+            logger.debug(f"✨ Added personality prefix")
+
+        # Show typing indicator and reply after a brief pause
+        await send_typing(chat_id, is_group)
+        reply = await reply_scheduler.submit(lambda: send_nemu_reply(message, response), typing_delay(response))
+
+        log_with_user_info("INFO", "✅ GLOBAL response scheduled", user_info)
+        return reply
+
+    else:
+        # No knowledge found, ask for teaching
+        log_with_user_info("INFO", "❓ No GLOBAL knowledge found", user_info)
+        
+        learning_response = random.choice(DONT_KNOW_MESSAGES)
+        logger.debug(f"📚 Selected global learning request")
+        
+        # Show typing indicator and reply after a brief pause
+        await send_typing(chat_id, is_group)
+        reply = await reply_scheduler.submit(lambda: send_nemu_reply(message, learning_response, query), typing_delay(learning_response))
+
+        log_with_user_info("INFO", "✅ GLOBAL learning request scheduled", user_info)
+        return reply
+
+# Schedule the reply confirming a teach, returning the reply task
+async def confirm_teaching(message: Message, action: str) -> Optional[asyncio.Task]:
+    # Send appropriate response with typing indicator
+    if action == "failed":
+        selected_message = random.choice(FAILURE_LEARNING_MESSAGES)
+    else:
+        selected_message = random.choice(SUCCESS_LEARNING_MESSAGES)
+
+    logger.debug(f"💬 Selected response message")
+
+    # Show typing indicator and reply after a brief pause
+    await send_typing(message.chat.id, message.chat.type != ChatType.PRIVATE)
+    return await reply_scheduler.submit(lambda: send_nemu_reply(message, selected_message), typing_delay(selected_message))
 
 # Handle all other messages
 @dp.message()
@@ -870,43 +3719,34 @@ async def handle_nemu_conversation(message: Message):
     text = message.text.strip()
     user = message.from_user
     chat_title = message.chat.title or message.chat.first_name or f"Chat {chat_id}"
+    is_group = message.chat.type != ChatType.PRIVATE
 
-    log_with_user_info("DEBUG", f"📨 Processing message: '{text[:100]}...'", user_info)
+    log_with_user_info("DEBUG", "📨 Processing message: '%.100s...'", user_info, text)
 
     try:
         # Check if replying to learning request
-        if message.reply_to_message and message.reply_to_message.message_id in learning_requests:
-            original_query = learning_requests[message.reply_to_message.message_id]
-            
-            log_with_user_info("INFO", f"🌍 User teaching Nemu GLOBALLY", user_info)
+        reply_key = None
+        original_query = None
+        if message.reply_to_message:
+            reply_key = pack_message_key(chat_id, message.reply_to_message.message_id)
+            original_query = await learning_requests.pop(reply_key)
 
-            # Learn from the reply
-            action = await learn_from_reply(chat_id, user_id, user.username or user.first_name, chat_title, original_query, text)
-
-            # Remove learning request
-            del learning_requests[message.reply_to_message.message_id]
+        if original_query is not None:
             logger.debug(f"🗑️ Removed learning request")
+            log_with_user_info("INFO", "🌍 User teaching Nemu GLOBALLY", user_info)
 
-            # Send appropriate response with typing indicator
-            if action == "failed":
-                selected_message = random.choice(FAILURE_LEARNING_MESSAGES)
-            else:
-                selected_message = random.choice(SUCCESS_LEARNING_MESSAGES)
-
-            logger.debug(f"💬 Selected response message")
-
-            # Show typing indicator
-            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(2)  # Brief pause for typing effect
+            # Learn from the reply
+            action = await learn_from_reply(chat_id, user_id, user.username or user.first_name, chat_title, original_query, text)
 
-            response_msg = await message.reply(selected_message, parse_mode=ParseMode.HTML)
-            bot_messages[response_msg.message_id] = True
+            log_with_user_info("INFO", "✅ GLOBAL learning completed: %s", user_info, action)
 
-            log_with_user_info("INFO", f"✅ GLOBAL learning completed: {action}", user_info)
+            # The teach is kept either way; only its confirmation shares the chat's reply budget
+            if not await chat_work.run(chat_id, lambda: confirm_teaching(message, action)):
+                log_with_user_info("WARNING", "🚮 Dropped teach confirmation for busy chat", user_info)
             return
 
         # Check if replying to bot
-        if message.reply_to_message and message.reply_to_message.message_id in bot_messages:
+        if reply_key is not None and await bot_messages.contains(reply_key):
             should_respond = True
             query = text
             log_with_user_info("DEBUG", "🔄 Reply to Nemu detected", user_info)
@@ -918,7 +3758,7 @@ async def handle_nemu_conversation(message: Message):
                     return
                 should_respond = True
                 query = extract_query_from_nemu_message(text)
-                log_with_user_info("DEBUG", f"🎯 Nemu trigger found", user_info)
+                log_with_user_info("DEBUG", "🎯 Nemu trigger found", user_info)
             else:
                 # Always respond in private
                 should_respond = True
@@ -934,99 +3774,92 @@ async def handle_nemu_conversation(message: Message):
 
         # Validate query length
         if not query or len(query.strip()) < 2:
-            log_with_user_info("WARNING", f"⚠️ Query too short", user_info)
+            log_with_user_info("WARNING", "⚠️ Query too short", user_info)
             return
 
-        # Search for existing response
-        logger.debug(f"🌍 Searching GLOBAL knowledge base")
-        response = await find_nemu_response(query)
-
-        if response:
-            # Found response in knowledge base
-            log_with_user_info("INFO", f"🧠 GLOBAL knowledge found", user_info)
-            await update_user_interaction(user_id, user.username, user.first_name, helped_by_nemu=True)
-
-            # Add personality prefix randomly
-            if random.random() < LEARNING_CONFIG["personality_chance"]:
-                personality_prefix = random.choice(PERSONALITY_PREFIXES)
-                response = personality_prefix + response
-                logger.debug(f"✨ Added personality prefix")
-
-            # Show typing indicator
-            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(2)  # Brief pause for typing effect
-
-            response_msg = await message.reply(response, parse_mode=ParseMode.HTML)
-            bot_messages[response_msg.message_id] = True
-
-            log_with_user_info("INFO", "✅ GLOBAL response sent", user_info)
-
-        else:
-            # No knowledge found, ask for teaching
-            log_with_user_info("INFO", f"❓ No GLOBAL knowledge found", user_info)
-            
-            learning_response = random.choice(DONT_KNOW_MESSAGES)
-            logger.debug(f"📚 Selected global learning request")
-            
-            # Show typing indicator
-            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(2)  # Brief pause for typing effect
-            
-            response_msg = await message.reply(learning_response, parse_mode=ParseMode.HTML)
-
-            # Store learning request
-            learning_requests[response_msg.message_id] = query
-            bot_messages[response_msg.message_id] = True
-            
-            logger.debug(f"📝 Stored GLOBAL learning request")
-
-            # Clean up old requests
-            if len(learning_requests) > LEARNING_CONFIG["max_learning_requests"]:
-                oldest_keys = list(learning_requests.keys())[:-LEARNING_CONFIG["max_learning_requests"]]
-                for key in oldest_keys:
-                    del learning_requests[key]
-                logger.debug(f"🧹 Cleaned up old learning requests")
-
-            # Clean up old messages
-            if len(bot_messages) > LEARNING_CONFIG["max_bot_messages"]:
-                oldest_keys = list(bot_messages.keys())[:-LEARNING_CONFIG["max_bot_messages"]]
-                for key in oldest_keys:
-                    del bot_messages[key]
-                logger.debug(f"🧹 Cleaned up old bot messages")
+        # Drop repeats of a query this chat just asked
+        if chat_work.is_duplicate(chat_id, normalize_trigger(query)):
+            log_with_user_info("DEBUG", "🔁 Duplicate query coalesced", user_info)
+            return
 
-            log_with_user_info("INFO", "✅ GLOBAL learning request sent", user_info)
+        # Answer within this chat's concurrency budget
+        admitted = await chat_work.run(chat_id, lambda: answer_nemu_query(message, query, user_info))
+        if not admitted:
+            log_with_user_info("WARNING", "🚮 Dropped stale work for busy chat", user_info)
 
+    except TelegramRetryAfter as e:
+        # Replying about a flood limit would only hit it again
+        rate_limiter.block(chat_id, e.retry_after)
+        log_with_user_info("WARNING", "⏳ Flood limited, skipping reply for %ss", user_info, e.retry_after)
     except Exception as e:
         logger.error(f"❌ Error in conversation handler: {str(e)}")
-        log_with_user_info("ERROR", f"❌ Conversation handling failed: {str(e)}", user_info)
+        log_with_user_info("ERROR", "❌ Conversation handling failed: %s", user_info, e)
         
         # Send error message to user
         try:
-            await message.reply("😅 Sorry, I encountered an error. Please try again!")
+            await send_rate_limited(
+                chat_id,
+                is_group,
+                lambda: message.reply("😅 Sorry, I encountered an error. Please try again!")
+            )
         except Exception as reply_error:
             logger.error(f"❌ Failed to send error message: {str(reply_error)}")
 
 # Main bot execution function
 async def main():
     logger.info("🚀 Nemu GLOBAL LEARNING initialization started...")
+    web_runner = None
 
     try:
+        # Start HTTP server for health checks and webhook updates
+        web_runner = await start_web_server()
+
+        # Warm lookups from a snapshot so the database only supplies recent changes
+        await load_knowledge_snapshot()
+
         # Initialize database connection
         logger.info("🗄️ Initializing database for global learning...")
-        db_success = await init_database()
+        db_success = await init_storage()
 
         if not db_success:
             logger.warning("⚠️ Starting Nemu without database connection!")
-            logger.warning("⚠️ Nemu will work with limited functionality")
+            logger.warning("⚠️ Nemu will serve journaled knowledge until the database recovers")
+            await seed_index_from_journal()
+        if knowledge_store is not None:
+            start_background_task(database_recovery_loop(), "database-recovery")
+            if KNOWLEDGE_INDEX_CONFIG["refresh_interval"] > 0:
+                start_background_task(knowledge_refresh_loop(), "knowledge-refresh")
+
+        # Connect shared reply tracking state
+        await init_reply_state()
 
         # Setup bot commands
         logger.info("⚙️ Setting up commands...")
         await setup_commands()
 
+        # Cache bot identity for /start
+        await refresh_bot_identity()
+        start_background_task(bot_identity_refresh_loop(), "bot-identity-refresh")
+
+        # Optionally pre-upload gallery images
+        if MEDIA_WARMUP_CHAT_ID:
+            start_background_task(warm_media_cache(), "media-warmup")
+
+        # Start write-behind flushing and loop monitoring
+        start_background_task(write_behind_loop(), "write-behind")
+        start_background_task(monitor_event_loop_lag(), "loop-lag-monitor")
+
         logger.info("🎉 Nemu GLOBAL LEARNING ready and starting...")
 
-        # Start polling for messages
-        await dp.start_polling(bot)
+        if RUN_MODE == "webhook":
+            # Receive updates through the HTTP server
+            await setup_webhook()
+            await wait_for_shutdown_signal()
+            logger.info("⏹️ Received shutdown signal, shutting down...")
+        else:
+            # Start polling for messages
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
         
     except KeyboardInterrupt:
         logger.info("⏹️ Received interrupt signal, shutting down...")
@@ -1036,19 +3869,41 @@ async def main():
     finally:
         # Clean up resources
         logger.info("🔧 Cleaning up resources...")
-        if db_pool:
-            try:
-                db_pool.close()
-                await db_pool.wait_closed()
-                logger.info("✅ Database pool closed")
-            except Exception as e:
-                logger.error(f"❌ Error closing database pool: {str(e)}")
+        if web_runner:
+            await web_runner.cleanup()
+        await reply_scheduler.shutdown()
+        for task in list(background_tasks):
+            task.cancel()
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        if usage_counters.pending:
+            logger.info(f"💾 Draining {usage_counters.pending} pending usage increments")
+            await flush_usage_counters()
+        if interaction_stats.pending:
+            logger.info(f"💾 Draining interaction stats for {interaction_stats.pending} users")
+            await flush_interaction_stats()
+        # Whatever could not be flushed survives in the journal
+        await spool_pending_stats()
+        await learning_requests.close()
+        await bot_messages.close()
+        if knowledge_store is not None:
+            await knowledge_store.close()
         
+        await bot.session.close()
         logger.info("👋 Nemu GLOBAL LEARNING shutdown complete")
 
-# Entry point for bot execution
+# Entry point for bot execution and maintenance commands
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nemu global learning bot")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("export-snapshot", help="stream nemu_global_knowledge to a snapshot file").add_argument("path")
+    commands.add_parser("import-snapshot", help="load a snapshot file into nemu_global_knowledge").add_argument("path")
+    commands.add_parser("migrate-fulltext", help="build the trigger FULLTEXT index on an existing table")
+    args = parser.parse_args()
+
     try:
+        if args.command:
+            raise SystemExit(asyncio.run(run_maintenance_command(args.command, getattr(args, "path", None))))
         logger.info("=" * 60)
         logger.info("🤖 NEMU BOT - GLOBAL LEARNING MODE - STARTING UP")
         logger.info("=" * 60)
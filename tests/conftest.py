@@ -0,0 +1,7 @@
+import os
+import sys
+
+# nemu builds its Bot at import time; a well-formed token is enough offline
+os.environ.setdefault("BOT_TOKEN", "123456:ABCdefGHIjklMNOpqrSTUvwxYZ012345678")
+os.environ.setdefault("LOG_QUEUE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,50 @@
+import asyncio
+
+import nemu
+
+
+# Scheduler that sheds work quickly so tests stay fast
+def make_schedulers():
+    chat_work = nemu.ChatWorkScheduler({**nemu.CHAT_WORK_CONFIG, "max_inflight_per_chat": 1, "max_queue_wait": 0.2})
+    return chat_work, nemu.ReplyScheduler(10)
+
+
+def test_slot_is_held_by_scheduled_reply_not_by_handler():
+    async def body():
+        chat_work, replies = make_schedulers()
+        sent = []
+
+        async def send():
+            sent.append(asyncio.get_running_loop().time())
+
+        started = asyncio.get_running_loop().time()
+        admitted = await chat_work.run(1, lambda: replies.submit(send, 0.5))
+        returned = asyncio.get_running_loop().time() - started
+
+        # The reply still owns the only slot, so the next query is shed
+        shed = await chat_work.run(1, lambda: replies.submit(send, 0))
+        await asyncio.sleep(0.5)
+        after = await chat_work.run(1, lambda: replies.submit(send, 0))
+        await asyncio.sleep(0.05)
+        return admitted, returned, shed, after, len(sent), chat_work.dropped
+
+    admitted, returned, shed, after, sent, dropped = asyncio.run(body())
+    assert admitted and after and not shed
+    assert returned < 0.1
+    assert sent == 2 and dropped == 1
+
+
+def test_slot_is_released_when_work_fails():
+    async def body():
+        chat_work, _ = make_schedulers()
+
+        async def fail():
+            raise RuntimeError("lookup failed")
+
+        try:
+            await chat_work.run(1, fail)
+        except RuntimeError:
+            pass
+        return await chat_work.run(1, lambda: asyncio.sleep(0))
+
+    assert asyncio.run(body())
@@ -0,0 +1,89 @@
+import random
+
+import nemu
+
+
+# Build an index from (trigger, response) pairs or (trigger, response, usage) triples
+def make_index(triggers, **options):
+    index = nemu.KnowledgeIndex(**options)
+    for knowledge_id, (trigger, response, *usage) in enumerate(triggers, start=1):
+        index.add(trigger, knowledge_id, response, usage[0] if usage else 0)
+    index.loaded = True
+    return index
+
+
+# Reference partial match: every trigger containing or contained in the query, ranked like find_partial
+def brute_force_partial(triggers, query):
+    candidates = [entry for entry in triggers if entry[0] in query or query in entry[0]]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda entry: (
+        min(len(entry[0]), len(query)) / max(len(entry[0]), len(query)),
+        entry[2],
+        [-ord(char) for char in entry[0]]
+    ))
+    return triggers.index(best) + 1, best[1]
+
+
+def test_trigger_containing_query_prefers_closest_length():
+    index = make_index([("say hello there friend", "long"), ("hello there", "close"), ("goodbye", "bye")])
+    assert index.find_partial("hello") == (2, "close")
+
+
+def test_trigger_contained_in_query_prefers_longest():
+    index = make_index([("hello", "short"), ("hello there", "long"), ("there", "other")])
+    assert index.find_partial("well hello there friend") == (2, "long")
+
+
+def test_triggers_shorter_than_an_ngram_still_match():
+    index = make_index([("hi", "hey"), ("yo", "sup")])
+    assert index.find_partial("oh hi mark") == (1, "hey")
+    assert index.find_partial("good morning") is None
+
+
+def test_containment_walk_respects_check_budget():
+    # Both query trigrams are equally common, and the shortest triggers sharing them never contain the query
+    triggers = [(f"abcq{i}", "decoy") for i in range(10)] + [(f"bcdq{i}", "decoy") for i in range(10)]
+    triggers.append(("abcd with a longer tail", "target"))
+    assert make_index(triggers, max_partial_checks=5).find_partial("abcd") is None
+    assert make_index(triggers, max_partial_checks=2000).find_partial("abcd") == (21, "target")
+
+
+def test_ties_break_on_usage_then_text_regardless_of_insertion_order():
+    pairs = [("hello", "first"), ("world", "second")]
+    assert make_index(pairs).find_partial("hello world") == (1, "first")
+    assert make_index(pairs[::-1]).find_partial("hello world") == (2, "first")
+    assert make_index([("hello", "first", 1), ("world", "second", 5)]).find_partial("hello world") == (2, "second")
+
+
+def test_matches_brute_force_on_random_triggers():
+    rng = random.Random(7)
+    words = ["ab", "abc", "bca", "cab", "hi", "b", "ca"]
+    seen = set()
+    triggers = []
+    while len(triggers) < 300:
+        trigger = " ".join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        if trigger not in seen:
+            seen.add(trigger)
+            triggers.append((trigger, f"response {len(triggers)}", rng.randint(0, 3)))
+    index = make_index(triggers)
+
+    for _ in range(500):
+        query = " ".join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+        assert index.find_partial(query) == brute_force_partial(triggers, query), query
+
+
+def test_result_does_not_depend_on_insertion_order():
+    rng = random.Random(3)
+    triggers = list({"".join(rng.choice("abcde ") for _ in range(rng.randint(3, 12))) for _ in range(2000)})
+    queries = ["".join(rng.choice("abcde ") for _ in range(8)) for _ in range(200)]
+
+    # Same id and response per trigger, so only the order of insertion differs
+    results = []
+    for _ in range(3):
+        rng.shuffle(triggers)
+        index = nemu.KnowledgeIndex()
+        for trigger in triggers:
+            index.add(trigger, sum(map(ord, trigger)), trigger.upper())
+        results.append([index.find_partial(query) for query in queries])
+    assert results[0] == results[1] == results[2]
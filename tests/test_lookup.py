@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import nemu
+
+
+# Store stand-in whose database lookups always fail
+class FailingStore:
+    available = True
+    fulltext_ready = True
+
+    async def lookup(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+
+@pytest.fixture
+def lookup_state(monkeypatch):
+    index = nemu.KnowledgeIndex()
+    index.add("hello", 1, "hi")
+    index.loaded = True
+    monkeypatch.setattr(nemu, "knowledge_index", index)
+    monkeypatch.setattr(nemu, "response_cache", nemu.ResponseCache(100, 300, 30))
+    monkeypatch.setattr(nemu, "lookup_tier_counts", dict.fromkeys(nemu.lookup_tier_counts, 0))
+    monkeypatch.setattr(nemu, "knowledge_store", FailingStore())
+
+
+def test_database_error_is_not_cached_as_miss(lookup_state):
+    assert asyncio.run(nemu.find_nemu_response("something else entirely")) is None
+    assert nemu.lookup_tier_counts["miss"] == 0
+    assert nemu.lookup_tier_counts["degraded"] == 1
+    assert nemu.response_cache.get("something else entirely") is nemu.CACHE_MISS
+
+
+def test_index_still_answers_when_database_fails(lookup_state):
+    assert asyncio.run(nemu.find_nemu_response("well hello there")) == "hi"
+    assert nemu.lookup_tier_counts["partial"] == 1
+
+
+def test_teach_fails_without_a_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(nemu, "knowledge_store", None)
+    monkeypatch.setattr(nemu, "write_journal", nemu.WriteJournal(str(tmp_path / "journal.jsonl")))
+    action = asyncio.run(nemu.learn_from_reply(1, 2, "user", "chat", "hello", "hi"))
+    assert action == "failed"
+    assert not (tmp_path / "journal.jsonl").exists()
+
+
+# Minimal aiomysql-shaped pool answering every statement with one row
+class FakePool:
+    def __init__(self, row=None, error=None):
+        self.row = row
+        self.error = error
+        self.executed = 0
+
+    async def acquire(self):
+        return self
+
+    def release(self, conn):
+        pass
+
+    def cursor(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, sql, args=None):
+        self.executed += 1
+        if self.error:
+            raise self.error
+
+    async def fetchone(self):
+        return self.row
+
+
+def test_replica_lookup_failure_retries_on_primary(monkeypatch):
+    primary = FakePool(row=("hi", 1, 1))
+    replica = FakePool(error=nemu.aiomysql.OperationalError(2013, "Lost connection"))
+    monkeypatch.setattr(nemu, "db_pool", primary)
+    monkeypatch.setattr(nemu, "db_read_pool", replica)
+    monkeypatch.setattr(nemu, "replica_healthy", True)
+    monkeypatch.setattr(nemu, "db_breaker", nemu.CircuitBreaker("database", 5, 30))
+
+    match = asyncio.run(nemu.MySQLKnowledgeStore().lookup("hello", "hello", True, False, False))
+    assert match == (1, "hi", "exact")
+    assert (replica.executed, primary.executed) == (1, 1)
+    assert not nemu.replica_healthy
+
+
+def test_fulltext_tier_waits_for_its_index(lookup_state, monkeypatch):
+    class NoFulltextStore(FailingStore):
+        fulltext_ready = False
+
+    monkeypatch.setattr(nemu, "knowledge_store", NoFulltextStore())
+    # With the index loaded, fulltext was the only tier left for the database
+    assert asyncio.run(nemu.lookup_knowledge("something else entirely")) is None
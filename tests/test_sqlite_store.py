@@ -0,0 +1,190 @@
+import asyncio
+
+import pytest
+
+import nemu
+
+
+# Run a coroutine against a fresh SQLite store installed as the knowledge store
+def run_with_store(tmp_path, monkeypatch, body, name="knowledge.db"):
+    async def runner():
+        store = nemu.SQLiteKnowledgeStore(str(tmp_path / name), readers=2)
+        await store.open()
+        monkeypatch.setattr(nemu, "knowledge_store", store)
+        try:
+            return await body(store)
+        finally:
+            await store.close()
+
+    return asyncio.run(runner())
+
+
+# Teach a trigger the way the bot does
+async def teach(store, query, response, user_id=1):
+    return await store.write_knowledge(-100, user_id, "user", "chat", query, response, nemu.normalize_trigger(query))
+
+
+# Run only the fulltext tier of the lookup cascade
+async def fulltext(store, query):
+    return await store.lookup(query, nemu.normalize_trigger(query), False, True, False)
+
+
+def test_write_knowledge_upserts_on_trigger(tmp_path, monkeypatch):
+    async def body(store):
+        first = await teach(store, "Hello there", "hi")
+        second = await teach(store, "hello   THERE", "hey", user_id=2)
+        match = await store.lookup("hello there", "hello there", True, False, False)
+        return first, second, match
+
+    first, second, match = run_with_store(tmp_path, monkeypatch, body)
+    assert first == (first[0], "learned")
+    assert second == (first[0], "updated")
+    assert match == (first[0], "hey", "exact")
+
+
+@pytest.mark.parametrize("query", ["i like pizza", "is it raining", "what is love"])
+def test_fulltext_needs_more_than_one_shared_word(tmp_path, monkeypatch, query):
+    async def body(store):
+        for trigger, response in [("i want a hug", "hug"), ("it is cold", "brr"), ("what time is it", "late")]:
+            await teach(store, trigger, response)
+        return await fulltext(store, query)
+
+    assert run_with_store(tmp_path, monkeypatch, body) is None
+
+
+def test_fulltext_matches_trigger_containing_every_word(tmp_path, monkeypatch):
+    async def body(store):
+        await teach(store, "what is your favourite food", "pizza")
+        await teach(store, "what is it", "nothing")
+        return await fulltext(store, "favourite food")
+
+    match = run_with_store(tmp_path, monkeypatch, body)
+    assert match[1:] == ("pizza", "fulltext")
+
+
+def test_partial_match_prefers_most_used_trigger(tmp_path, monkeypatch):
+    async def body(store):
+        quiet, _ = await teach(store, "good morning", "morning")
+        busy, _ = await teach(store, "good morning nemu", "gm")
+        await store.add_usage({busy: 3})
+        return quiet, busy, await store.lookup("good morning nemu chan", "good morning nemu chan", False, False, True)
+
+    quiet, busy, match = run_with_store(tmp_path, monkeypatch, body)
+    assert match == (busy, "gm", "partial")
+
+
+def test_iter_knowledge_returns_only_changed_rows(tmp_path, monkeypatch):
+    async def body(store):
+        await teach(store, "old trigger", "old")
+        await store._write(lambda conn: conn.execute("UPDATE nemu_global_knowledge SET updated_at = '2000-01-01 00:00:00'"))
+        await teach(store, "new trigger", "new")
+        return [row async for rows in store.iter_knowledge(10, "2020-01-01 00:00:00") for row in rows]
+
+    rows = run_with_store(tmp_path, monkeypatch, body)
+    assert [row[1] for row in rows] == ["new trigger"]
+
+
+def test_upsert_interactions_accumulates(tmp_path, monkeypatch):
+    delta = {"username": "user", "first_name": None, "total_messages": 2, "times_helped_by_nemu": 1, "times_taught_nemu": 0}
+
+    async def body(store):
+        await store.upsert_interactions({7: delta})
+        await store.upsert_interactions({7: {**delta, "username": None, "first_name": "Name"}})
+        return await store._read(lambda conn: conn.execute("""
+            SELECT username, first_name, total_messages, times_helped_by_nemu FROM nemu_interactions WHERE user_id = 7
+        """).fetchone())
+
+    assert run_with_store(tmp_path, monkeypatch, body) == ("user", "Name", 4, 2)
+
+
+def test_snapshot_round_trip(tmp_path, monkeypatch):
+    path = str(tmp_path / "knowledge.snap")
+
+    async def export(store):
+        for index in range(25):
+            await teach(store, f"trigger {index}", f"response {index}")
+        await store.add_usage({1: 5})
+        await nemu.export_knowledge_snapshot(path)
+        return await store._read(lambda conn: conn.execute("""
+            SELECT trigger_message, response, global_usage_count FROM nemu_global_knowledge ORDER BY trigger_message
+        """).fetchall())
+
+    async def restore(store):
+        await nemu.import_knowledge_snapshot(path)
+        return await store._read(lambda conn: conn.execute("""
+            SELECT trigger_message, response, global_usage_count FROM nemu_global_knowledge ORDER BY trigger_message
+        """).fetchall())
+
+    monkeypatch.setitem(nemu.SNAPSHOT_CONFIG, "chunk_rows", 10)
+    exported = run_with_store(tmp_path, monkeypatch, export, "source.db")
+    assert run_with_store(tmp_path, monkeypatch, restore, "target.db") == exported
+
+    rows, footer = nemu.read_snapshot_index(path)
+    assert footer["rows"] == 25
+    assert rows[0][1:] == ("trigger 0", "response 0", 5)
+
+
+def test_snapshot_import_merges_into_existing_knowledge(tmp_path, monkeypatch):
+    path = str(tmp_path / "knowledge.snap")
+
+    async def export(store):
+        await teach(store, "hello", "hi")
+        await teach(store, "good night", "sleep well")
+        await nemu.export_knowledge_snapshot(path)
+
+    async def restore(store):
+        await teach(store, "bye", "see you")
+        await teach(store, "good night", "nighty night")
+        await store._write(lambda conn: conn.execute("UPDATE nemu_global_knowledge SET updated_at = '2000-01-01 00:00:00'"))
+        # Importing twice must leave the table as after the first import
+        await nemu.import_knowledge_snapshot(path)
+        await nemu.import_knowledge_snapshot(path)
+        return await store._read(lambda conn: conn.execute("""
+            SELECT id, trigger_message, response FROM nemu_global_knowledge ORDER BY id
+        """).fetchall())
+
+    run_with_store(tmp_path, monkeypatch, export, "source.db")
+    rows = run_with_store(tmp_path, monkeypatch, restore, "target.db")
+    assert rows[:2] == [(1, "bye", "see you"), (2, "good night", "sleep well")]
+    assert [row[1:] for row in rows[2:]] == [("hello", "hi")]
+
+
+def test_refresh_picks_up_teaches_from_another_replica(tmp_path, monkeypatch):
+    async def body(store):
+        other = nemu.SQLiteKnowledgeStore(str(tmp_path / "knowledge.db"), readers=1)
+        await other.open()
+        monkeypatch.setattr(nemu, "knowledge_index", nemu.KnowledgeIndex())
+        monkeypatch.setattr(nemu, "response_cache", nemu.ResponseCache(100, 300, 30))
+        try:
+            await teach(store, "hello", "hi")
+            await nemu.load_knowledge_index()
+            nemu.response_cache.put_negative("good morning")
+            await teach(other, "good morning", "gm")
+            return await nemu.refresh_knowledge_changes(), await nemu.refresh_knowledge_changes()
+        finally:
+            await other.close()
+
+    assert run_with_store(tmp_path, monkeypatch, body) == (1, 0)
+    assert nemu.knowledge_index.get("good morning")[1] == "gm"
+    assert nemu.response_cache.get("good morning") is nemu.CACHE_MISS
+
+
+def test_snapshot_warm_start_picks_up_later_teaches(tmp_path, monkeypatch):
+    path = str(tmp_path / "knowledge.snap")
+    monkeypatch.setitem(nemu.SNAPSHOT_CONFIG, "path", path)
+    monkeypatch.setattr(nemu, "knowledge_index", nemu.KnowledgeIndex())
+    monkeypatch.setattr(nemu, "index_watermark", None)
+
+    async def body(store):
+        await teach(store, "hello", "hi")
+        await nemu.export_knowledge_snapshot(path)
+        await teach(store, "hello", "hey there")
+        await nemu.load_knowledge_snapshot()
+        warmed = nemu.knowledge_index.get("hello"), nemu.index_watermark
+        await nemu.load_knowledge_index()
+        return warmed, nemu.knowledge_index.get("hello")
+
+    (warmed, watermark), loaded = run_with_store(tmp_path, monkeypatch, body)
+    assert warmed == (1, "hi")
+    assert watermark == nemu.read_snapshot_index(path)[1]["watermark"]
+    assert loaded == (1, "hey there")